@@ -2,8 +2,29 @@ import os
 import json
 import time
 import asyncio
+import collections
 import aiohttp
-import uuid
+import argparse
+import hashlib
+import codecs
+import gzip
+import shutil
+import filecmp
+import tempfile
+import configparser
+import contextlib
+import base64
+import random
+import datetime
+import email.utils
+import urllib.parse
+import fnmatch
+import math
+import array
+try:
+    import zstandard
+except ImportError:  # zstd необязателен, без него архив сжимается gzip
+    zstandard = None
 
 '''Вспомогательные функции и глобальные переменные'''
 def load_credentials(file_path):
@@ -17,126 +38,1756 @@ def load_credentials(file_path):
                 credentials[key] = value            
     return credentials
 
-creds = load_credentials('creds.txt')
-url_backup_api = f'https://{creds["BACKUP_HOST"]}/api/ptaf/v4'
-url_restore_api = f'https://{creds["RESTORE_HOST"]}/api/ptaf/v4'
-
-async def fetch_data(url, headers):
-    # Создаем сессию с отключенной проверкой SSL
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-        async with session.get(url, headers=headers) as response:
-            # Получаем текст ответа
-            return await response.json()
-
-async def post_data(url, payload):
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-        async with session.post(url, json=payload) as response:
-            return await response.json()
-
-async def post_with_headers_data(url, headers, payload):
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-        async with session.post(url, headers=headers, json=payload) as response:
-            return await response.json()
-  
-async def patch_data(url, headers, payload):
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-        async with session.patch(url, headers=headers, json=payload) as response:
-            return await response.json()
-
-async def fetch_and_save_file(url, headers, save_path):
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-        async with session.get(url, headers=headers) as response:
-            # Проверяем, что запрос был успешным
-            if response.status == 200:
-                # Читаем содержимое ответа
-                content = await response.text()
-                # Разделяем содержимое на строки и убираем лишние пустые строки
-                lines = [line.strip() for line in content.splitlines() if line.strip()]
-                # Сохраняем содержимое в файл
-                with open(save_path, 'w', encoding='utf-8') as file:
-                    file.write('\n'.join(lines))                
-            else:
-                print(f"Ошибка при запросе: {response.status}")
-
-async def get_headers(host,user,password):    
-    login_url = f'https://{host}/api/ptaf/v4/auth/refresh_tokens'
-    # Получение токена авторизации
-    login_data = {"username": f'{user}',"password": f'{password}',"fingerprint": "testuser"}
-    response_data = await post_data(login_url, login_data)
-    access_token = response_data.get('access_token')
-    headers= {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {access_token}'
+class Tenant:
+    """Тенант PT AF: адрес, учётная запись, каталог снимка, свой лимит одновременных запросов
+    и размер страницы листингов. store_name - имя тенанта в хранилище снимков (по умолчанию name)."""
+    def __init__(self, name, host, username, password, root='backup', max_concurrency=None, page_size=None,
+                 store_name=None):
+        self.name = name
+        self.store_name = store_name or name
+        self.host = host
+        self.username = username
+        self.password = password
+        self.root = root
+        self.max_concurrency = max_concurrency or MAX_CONCURRENCY
+        self.page_size = page_size or PAGE_SIZE
+
+    @classmethod
+    def from_creds(cls, creds, role, root='backup', max_concurrency=None, page_size=None):
+        """Тенант из creds.txt: role - BACKUP (откуда снимаем) или RESTORE (куда восстанавливаем).
+        В хранилище снимков тенант называется по адресу: роль в разных creds.txt - разные тенанты."""
+        host = creds[f'{role}_HOST']
+        store_name = ''.join(char if char.isalnum() or char in '.-' else '_' for char in host)
+        return cls(role.lower(), host, creds[f'{role}_USERNAME'], creds[f'{role}_PASSWORD'],
+                   root, max_concurrency, page_size, store_name)
+
+def load_inventory(file_path, root='backups', max_concurrency=None, page_size=None):
+    """Тенанты из INI-файла: секция - имя тенанта (и его подкаталог в root),
+    ключи HOST, USERNAME, PASSWORD и необязательные CONCURRENCY и PAGE_SIZE."""
+    inventory = configparser.ConfigParser(interpolation=None)
+    with open(file_path, 'r', encoding='utf-8') as file:
+        inventory.read_file(file)
+    tenants = []
+    for name in inventory.sections():
+        section = inventory[name]
+        tenants.append(Tenant(name, section['HOST'], section['USERNAME'], section['PASSWORD'],
+                              os.path.join(root, name), section.getint('CONCURRENCY', max_concurrency),
+                              section.getint('PAGE_SIZE', page_size)))
+    return tenants
+
+
+# Сколько запросов к API одного тенанта может быть в полёте одновременно
+MAX_CONCURRENCY = 20
+# Сколько шаблонов (политик) обрабатывается одновременно при бекапе
+PIPELINE_WINDOW = 16
+# Размер куска при потоковом скачивании файлов списков
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Сколько элементов запрашивать в одной странице листинга (limit/offset)
+PAGE_SIZE = 500
+# Фильтр листинга правил: только изменённые. Сервер, который его не принимает, получит листинг без фильтра
+RULES_OVERRIDES_FILTER = {'has_overrides': 'true'}
+
+class ReferenceCache:
+    """Справочники тенанта (действия, списки, типы действий, шаблоны), загружаемые один раз за прогон.
+
+    Ключ - URL справочника. Одновременные запросы одного ключа ждут одну общую загрузку.
+    """
+    def __init__(self):
+        self._tasks = {}
+
+    async def get(self, key, loader):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(loader())
+            self._tasks[key] = task
+        try:
+            # shield: отмена одного из ожидающих не должна отменять общую загрузку
+            return await asyncio.shield(task)
+        except Exception:
+            # Неудачную загрузку не кэшируем, следующий вызов попробует снова
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+            raise
+
+    def invalidate(self, key):
+        """Сбрасывает справочник и построенные по нему индексы, например после создания объектов в тенанте."""
+        self._tasks.pop(key, None)
+        self._tasks.pop((key, 'index'), None)
+
+# Повторы запросов: сколько раз и с какой паузой (полный джиттер, пауза растёт экспоненциально)
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# Retry-After больше этого значения не ждём, иначе прогон может встать на часы
+RETRY_AFTER_MAX = 120
+# Временные ошибки: API перегружен или недоступен, запрос можно повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Для POST повтор безопасен, только если сервер точно не обработал запрос
+RETRY_STATUSES_UNSAFE = {429, 503}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'PATCH', 'DELETE'}
+
+class ApiError(Exception):
+    """API ответило ошибкой или телом, которое не удалось разобрать."""
+    def __init__(self, method, url, status, text=''):
+        self.method = method
+        self.url = url
+        self.status = status
+        super().__init__(f"{method} {url}: HTTP {status} {text[:200]}".rstrip())
+
+class TransientApiError(ApiError):
+    """Временная ошибка (перегрузка, недоступность), запрос стоит повторить."""
+    def __init__(self, method, url, status, text='', retry_after=None):
+        super().__init__(method, url, status, text)
+        self.retry_after = retry_after
+
+class AdaptiveLimiter:
+    """Ограничитель одновременных запросов к тенанту с адаптивным лимитом (AIMD).
+
+    Лимит растёт на единицу за "окно" успешных запросов и вдвое падает при перегрузке:
+    429/5xx, обрыв соединения или рост задержки ответа в LATENCY_TOLERANCE раз (и не меньше
+    чем на LATENCY_SLACK секунд) от лучшей наблюдавшейся. Лимит не падает чаще раза за одну
+    задержку ответа и не превышает max_limit.
+    """
+    LATENCY_TOLERANCE = 3
+    LATENCY_SLACK = 0.5
+    EWMA_WEIGHT = 0.1
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.latency = None       # Сглаженная задержка до заголовков ответа
+        self.best_latency = None  # Лучшая сглаженная задержка - ориентир "API не перегружено"
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self._waiters = collections.deque()
+
+    async def __aenter__(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # Место освобождающий запрос передаёт нам сразу, in_flight уже учтён в _wake
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self._release()
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        """Отдаёт свободные места ждущим по очереди; лимит мог и вырасти, и упасть."""
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def observe(self, latency):
+        """Задержка очередного ответа; её рост - сигнал перегрузки раньше, чем посыплются ошибки."""
+        self.latency = latency if self.latency is None else \
+            self.latency + self.EWMA_WEIGHT * (latency - self.latency)
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+        if self.latency > max(self.best_latency * self.LATENCY_TOLERANCE, self.best_latency + self.LATENCY_SLACK):
+            self.on_overload()
+
+    def on_success(self):
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()
+
+    def on_overload(self):
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 0):
+            # Ответы, начатые до прошлого снижения, ещё не отражают новый лимит
+            return
+        self.limit = max(self.min_limit, self.limit / 2)
+        self.last_decrease = now
+        self.decreases += 1
+
+# За сколько секунд до истечения токена он обновляется заранее
+TOKEN_REFRESH_MARGIN = 60
+# Срок жизни токена, если его не удалось прочитать из самого токена (JWT exp)
+TOKEN_TTL_FALLBACK = 15 * 60
+
+class UnauthorizedError(ApiError):
+    """401: токен, с которым ушёл запрос, истёк или отозван."""
+    def __init__(self, method, url, status, text='', authorization=None):
+        super().__init__(method, url, status, text)
+        self.authorization = authorization
+
+def token_expires_at(token):
+    """Время истечения токена из поля exp JWT; подпись не проверяется, нужно только время."""
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, ValueError, TypeError, KeyError):
+        return time.time() + TOKEN_TTL_FALLBACK
+
+class AuthManager:
+    """Токен доступа тенанта, общий для всех запросов клиента.
+
+    Токен обновляется заранее, за TOKEN_REFRESH_MARGIN секунд до истечения, и после 401.
+    Вход выполняется одной общей задачей: сколько бы запросов ни ждали токен, в API уходит один вход.
+    """
+    def __init__(self, client, username, password):
+        self.client = client
+        self.login_url = f'{client.api}/auth/refresh_tokens'
+        self.login_data = {"username": f'{username}', "password": f'{password}', "fingerprint": "testuser"}
+        self.access_token = None
+        self.refresh_at = 0
+        self.refreshes = 0
+        self._refresh = None
+
+    @property
+    def headers(self):
+        return {
+            'Accept': 'application/json',
+            'Authorization': f'Bearer {self.access_token}'
         }
-    return headers
 
-async def get_token(host,user,password):
-    
-    login_url = f'https://{host}/api/ptaf/v4/auth/refresh_tokens'
+    async def ensure_fresh(self):
+        if self.access_token is None or time.time() > self.refresh_at:
+            await self.refresh()
+
+    async def refresh(self, stale_authorization=None):
+        """Получает новый токен. stale_authorization - заголовок запроса, получившего 401:
+        если токен с тех пор уже обновили, повторный вход не нужен."""
+        if stale_authorization is not None and stale_authorization != self.headers['Authorization']:
+            return
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._login())
+        # shield: отмена одного из ждущих запросов не должна отменять общий вход
+        await asyncio.shield(self._refresh)
+
+    async def _login(self):
+        try:
+            response_data = await post_data(self.client, self.login_url, self.login_data)
+            access_token = (response_data or {}).get('access_token')
+            if not access_token:
+                raise ApiError('POST', self.login_url, 200, 'в ответе нет access_token')
+            self.access_token = access_token
+            # Короткоживущий токен обновляем на середине срока, а не сразу после получения
+            now = time.time()
+            expires_at = token_expires_at(access_token)
+            self.refresh_at = expires_at - min(TOKEN_REFRESH_MARGIN, (expires_at - now) / 2)
+            self.refreshes += 1
+        finally:
+            self._refresh = None
+
+'''Метрики'''
+API_PATH = '/api/ptaf/v4'
+# Сегменты пути, которые не id объектов: по ним запросы группируются в эндпоинты
+ENDPOINT_SEGMENTS = {'auth', 'refresh_tokens', 'config', 'policies', 'templates', 'user', 'vendor', 'rules',
+                     'global_lists', 'file', 'apply', 'actions', 'action_types', 'applications'}
+LATENCY_QUANTILES = (0.5, 0.95, 0.99)
+
+def endpoint_name(method, url):
+    """Эндпоинт запроса без id объектов: 'GET /config/policies/{id}/rules'."""
+    path = urllib.parse.urlsplit(str(url)).path.removeprefix(API_PATH)
+    segments = [segment if segment in ENDPOINT_SEGMENTS else '{id}' for segment in path.strip('/').split('/')]
+    return f"{method} /{'/'.join(segments)}"
+
+def percentile(values, q):
+    """Перцентиль отсортированных значений (ближайший ранг)."""
+    if not values:
+        return None
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    summary = {f'p{round(q * 100)}': percentile(latencies, q) for q in LATENCY_QUANTILES}
+    summary['max'] = latencies[-1] if latencies else None
+    summary['total'] = sum(latencies)
+    summary['count'] = len(latencies)
+    return summary
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = collections.Counter()  # HTTP-статус или класс исключения -> сколько раз
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latencies = array.array('d')
+
+    def report(self):
+        return {
+            'requests': self.requests,
+            'errors': dict(self.errors),
+            'retries': self.retries,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'latency': latency_summary(self.latencies)
+        }
+
+class RequestMetrics:
+    """Метрики HTTP-запросов одного клиента по эндпоинтам.
+
+    Каждая попытка - отдельный запрос. Задержка меряется до заголовков ответа, как и для лимитера;
+    in_flight - сколько запросов клиента было в работе (включая чтение тела) в момент начала запроса.
+    """
+    def __init__(self):
+        self.endpoints = collections.defaultdict(EndpointStats)
+        self.in_flight_peak = 0
+        self._in_flight_sum = 0
+
+    def request_started(self, endpoint, in_flight):
+        self.endpoints[endpoint].requests += 1
+        self.in_flight_peak = max(self.in_flight_peak, in_flight)
+        self._in_flight_sum += in_flight
+
+    def request_finished(self, endpoint, latency, status):
+        stats = self.endpoints[endpoint]
+        stats.latencies.append(latency)
+        if status >= 400:
+            stats.errors[str(status)] += 1
+
+    def request_failed(self, endpoint, error):
+        self.endpoints[endpoint].errors[type(error).__name__] += 1
+
+    def retried(self, method, url):
+        self.endpoints[endpoint_name(method, url)].retries += 1
+
+    def report(self):
+        endpoints = sorted(self.endpoints.items(), key=lambda item: sum(item[1].latencies), reverse=True)
+        requests = sum(stats.requests for stats in self.endpoints.values())
+        return {
+            'requests': requests,
+            'errors': sum(sum(stats.errors.values()) for stats in self.endpoints.values()),
+            'retries': sum(stats.retries for stats in self.endpoints.values()),
+            'bytes_sent': sum(stats.bytes_sent for stats in self.endpoints.values()),
+            'bytes_received': sum(stats.bytes_received for stats in self.endpoints.values()),
+            'latency': latency_summary(latency for stats in self.endpoints.values() for latency in stats.latencies),
+            'in_flight': {'peak': self.in_flight_peak, 'mean': self._in_flight_sum / requests if requests else 0},
+            # Эндпоинты - по убыванию суммарной задержки: первый и есть самый "дорогой"
+            'endpoints': {name: stats.report() for name, stats in endpoints}
+        }
+
+class RunReport:
+    """Отчёт о прогоне: время этапов и метрики запросов каждого тенанта.
+
+    Пишется в JSON и, при желании, в textfile для node_exporter (Prometheus).
+    Этап, запущенный несколько раз (как при синхронизации), учитывается одной записью:
+    calls - сколько раз, busy - суммарное время, seconds - от первого запуска до последнего завершения.
+    """
+    def __init__(self, operation):
+        self.operation = operation
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.clients = {}
+        self.stages = {}
+
+    def add_client(self, tenant_name, client):
+        self.clients[tenant_name] = client
+
+    def tenant_of(self, client):
+        return next((name for name, known in self.clients.items() if known is client), client.host)
+
+    async def timed(self, client, coroutine):
+        """Выполняет этап coroutine и записывает его время; имя этапа - имя функции."""
+        started = time.monotonic()
+        failed = True
+        try:
+            result = await coroutine
+            failed = False
+            return result
+        finally:
+            finished = time.monotonic()
+            key = (self.tenant_of(client), coroutine.__name__)
+            stage = self.stages.setdefault(key, {'tenant': key[0], 'stage': key[1], 'calls': 0, 'failed': 0,
+                                                 'started': started - self._started, 'seconds': 0, 'busy': 0})
+            stage['calls'] += 1
+            stage['failed'] += failed
+            stage['busy'] += finished - started
+            stage['seconds'] = finished - self._started - stage['started']
+
+    def report(self):
+        tenants = {}
+        for name, client in self.clients.items():
+            tenants[name] = client.metrics.report()
+            tenants[name]['limit'] = {'final': int(client.limiter.limit), 'decreases': client.limiter.decreases}
+            tenants[name]['logins'] = client.auth.refreshes if client.auth is not None else 0
+        return {
+            'operation': self.operation,
+            'started_at': datetime.datetime.fromtimestamp(self.started_at, datetime.timezone.utc).isoformat(),
+            'seconds': time.monotonic() - self._started,
+            'stages': sorted(self.stages.values(), key=lambda stage: stage['started']),
+            'tenants': tenants
+        }
+
+    def write_json(self, file_path):
+        write_json(file_path, self.report())
+
+    def write_prometheus(self, file_path):
+        """Textfile для node_exporter; пишется во временный файл и подменяется целиком,
+        чтобы сборщик не прочитал его наполовину."""
+        report = self.report()
+        metrics = collections.defaultdict(list)
+
+        def sample(metric, value, family=None, **labels):
+            labels = {'operation': self.operation, **labels}
+            text = ','.join(f'{key}="{prometheus_escape(str(label))}"' for key, label in labels.items())
+            # Сэмплы одного семейства (у summary это ещё _sum и _count) должны идти подряд
+            metrics[family or metric].append(f'{metric}{{{text}}} {value}')
+
+        sample('ptaf_run_duration_seconds', report['seconds'])
+        sample('ptaf_run_timestamp_seconds', self.started_at)
+        for stage in report['stages']:
+            sample('ptaf_stage_duration_seconds', stage['seconds'], tenant=stage['tenant'], stage=stage['stage'])
+        for tenant, data in report['tenants'].items():
+            sample('ptaf_in_flight_peak', data['in_flight']['peak'], tenant=tenant)
+            sample('ptaf_concurrency_limit', data['limit']['final'], tenant=tenant)
+            for endpoint, stats in data['endpoints'].items():
+                labels = {'tenant': tenant, 'endpoint': endpoint}
+                sample('ptaf_requests_total', stats['requests'], **labels)
+                sample('ptaf_request_retries_total', stats['retries'], **labels)
+                sample('ptaf_request_bytes_total', stats['bytes_sent'], **labels)
+                sample('ptaf_response_bytes_total', stats['bytes_received'], **labels)
+                for error, count in stats['errors'].items():
+                    sample('ptaf_request_errors_total', count, error=error, **labels)
+                latency = stats['latency']
+                for q in LATENCY_QUANTILES:
+                    value = latency[f'p{round(q * 100)}']
+                    if value is not None:
+                        sample('ptaf_request_latency_seconds', value, quantile=q, **labels)
+                sample('ptaf_request_latency_seconds_sum', latency['total'], 'ptaf_request_latency_seconds', **labels)
+                sample('ptaf_request_latency_seconds_count', latency['count'], 'ptaf_request_latency_seconds', **labels)
+        lines = []
+        for family, samples in metrics.items():
+            help_text, metric_type = PROMETHEUS_METRICS[family]
+            lines += [f'# HELP {family} {help_text}', f'# TYPE {family} {metric_type}', *samples]
+        part_path = f'{file_path}.part'
+        with open(part_path, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(part_path, file_path)
+
+    def print_summary(self, top=3):
+        """Кратко: какие эндпоинты дольше всего ждали."""
+        for name, data in self.report()['tenants'].items():
+            slowest = ', '.join(f"{endpoint} ({stats['requests']} запр., {stats['latency']['total']:.1f} с)"
+                                for endpoint, stats in list(data['endpoints'].items())[:top])
+            if slowest:
+                print(f"Тенант {name}: дольше всего ждали {slowest}")
+
+PROMETHEUS_METRICS = {
+    'ptaf_run_duration_seconds': ('Длительность прогона', 'gauge'),
+    'ptaf_run_timestamp_seconds': ('Время начала прогона', 'gauge'),
+    'ptaf_stage_duration_seconds': ('Длительность этапа', 'gauge'),
+    'ptaf_in_flight_peak': ('Пик одновременных запросов к тенанту', 'gauge'),
+    'ptaf_concurrency_limit': ('Лимит одновременных запросов в конце прогона', 'gauge'),
+    'ptaf_requests_total': ('Запросы к API, включая повторы', 'counter'),
+    'ptaf_request_retries_total': ('Повторы запросов', 'counter'),
+    'ptaf_request_bytes_total': ('Отправлено байт в телах запросов', 'counter'),
+    'ptaf_response_bytes_total': ('Получено байт в телах ответов', 'counter'),
+    'ptaf_request_errors_total': ('Ответы с ошибкой и оборванные запросы', 'counter'),
+    'ptaf_request_latency_seconds': ('Задержка до заголовков ответа', 'summary'),
+}
+
+def prometheus_escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class ApiClient:
+    """Долгоживущий HTTP-клиент одного тенанта.
+
+    Держит один пул соединений на весь прогон (keep-alive, лимит соединений на хост,
+    кэш DNS), чтобы не платить за TCP+TLS рукопожатие на каждый запрос.
+    limiter ограничивает число одновременных запросов и подстраивает лимит под нагрузку API,
+    чтобы параллельный обход правил не заваливал его, а refs хранит справочники тенанта.
+    metrics собирает по эндпоинтам число запросов, ошибки, задержки и объём данных.
+    budget - общий на процесс семафор, когда одновременно обслуживается несколько тенантов.
+    page_size - размер страницы листингов, rules_filter - фильтр листинга правил, пока сервер его принимает.
+    """
+    def __init__(self, host, max_concurrency=MAX_CONCURRENCY, limit=100, keepalive_timeout=75, ttl_dns_cache=600,
+                 budget=None, page_size=PAGE_SIZE):
+        self.host = host
+        self.page_size = page_size
+        self.rules_filter = RULES_OVERRIDES_FILTER
+        self.api = f'https://{host}{API_PATH}'
+        self.budget = budget
+        self.auth = None
+        self.session = None
+        self.limiter = AdaptiveLimiter(max_concurrency)
+        self.refs = ReferenceCache()
+        self.metrics = RequestMetrics()
+        self.retries = 0
+        self._connector_params = {
+            'ssl': False,  # Проверка SSL отключена, как и раньше
+            'limit': limit,
+            'limit_per_host': max_concurrency,
+            'keepalive_timeout': keepalive_timeout,
+            'ttl_dns_cache': ttl_dns_cache,
+        }
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(**self._connector_params)
+        # Задержку меряем до заголовков ответа: время скачивания больших списков не сигнал перегрузки
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_request_end.append(self._on_request_end)
+        trace.on_request_exception.append(self._on_request_exception)
+        trace.on_request_chunk_sent.append(self._on_request_chunk_sent)
+        trace.on_response_chunk_received.append(self._on_response_chunk_received)
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    @property
+    def headers(self):
+        return self.auth.headers if self.auth is not None else {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Место для одного запроса: в лимите тенанта и, если задан, в общем бюджете процесса."""
+        async with self.limiter:
+            if self.budget is None:
+                yield
+            else:
+                async with self.budget:
+                    yield
+
+    async def _on_request_start(self, session, context, params):
+        context.started = time.monotonic()
+        context.endpoint = endpoint_name(params.method, params.url)
+        self.metrics.request_started(context.endpoint, self.limiter.in_flight)
+
+    async def _on_request_end(self, session, context, params):
+        latency = time.monotonic() - context.started
+        self.limiter.observe(latency)
+        self.metrics.request_finished(context.endpoint, latency, params.response.status)
+
+    async def _on_request_exception(self, session, context, params):
+        self.metrics.request_failed(context.endpoint, params.exception)
 
-    # Получение токена авторизации
-    login_data = {"username": f'{user}',"password": f'{password}',"fingerprint": "testuser"}
-    response_data = await post_data(login_url, login_data)
-    access_token = response_data.get('access_token')
-    return access_token
+    async def _on_request_chunk_sent(self, session, context, params):
+        self.metrics.endpoints[context.endpoint].bytes_sent += len(params.chunk)
+
+    async def _on_response_chunk_received(self, session, context, params):
+        self.metrics.endpoints[context.endpoint].bytes_received += len(params.chunk)
+
+def parse_retry_after(value):
+    """Retry-After в секундах: число секунд или HTTP-дата."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (email.utils.parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), RETRY_AFTER_MAX)
+
+def retry_delay(attempt, retry_after=None):
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+async def check_response(response, ok=(200, 201, 204)):
+    """Поднимает ApiError (TransientApiError для временных ошибок), если статус ответа не из ok."""
+    if response.status in ok:
+        return
+    text = await response.text(errors='replace')
+    if response.status == 401:
+        raise UnauthorizedError(response.method, response.url, response.status, text,
+                                response.request_info.headers.get('Authorization'))
+    if response.status in RETRY_STATUSES:
+        raise TransientApiError(response.method, response.url, response.status, text,
+                                parse_retry_after(response.headers.get('Retry-After')))
+    raise ApiError(response.method, response.url, response.status, text)
+
+async def read_json_body(response):
+    text = await response.text(errors='replace')
+    if not text.strip():
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        # Например, HTML-страница прокси вместо ответа API
+        raise ApiError(response.method, response.url, response.status, f"ответ не JSON: {text}") from None
+
+async def with_retries(client, method, url, attempt, authenticated=True):
+    """Выполняет attempt() под лимитером, повторяя его при временных ошибках.
+
+    Пауза между попытками - экспоненциальная с джиттером, но не меньше Retry-After.
+    Неидемпотентные запросы (POST) повторяются, только если сервер их точно не обработал.
+    Перед попыткой токен при необходимости обновляется, после 401 запрос один раз
+    повторяется с новым токеном (401 значит, что запрос не выполнен, так что и POST можно).
+    """
+    idempotent = method in IDEMPOTENT_METHODS
+    # Вход идёт мимо лимитера: его ждут запросы, уже занявшие все места
+    slot = client.slot if authenticated else contextlib.nullcontext
+    reauthenticated = False
+    retry = 0
+    while True:
+        try:
+            async with slot():
+                # Токен проверяем уже заняв место: в очереди лимитера он мог истечь
+                if authenticated and client.auth is not None:
+                    await client.auth.ensure_fresh()
+                result = await attempt()
+            client.limiter.on_success()
+            return result
+        except UnauthorizedError as e:
+            if not authenticated or client.auth is None or reauthenticated:
+                raise
+            reauthenticated = True
+            await client.auth.refresh(e.authorization)
+            continue
+        except TransientApiError as e:
+            client.limiter.on_overload()
+            if retry == MAX_RETRIES or not (idempotent or e.status in RETRY_STATUSES_UNSAFE):
+                raise
+            delay = retry_delay(retry, e.retry_after)
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            client.limiter.on_overload()
+            # Если соединение не установилось, POST точно не дошёл до сервера
+            if retry == MAX_RETRIES or not (idempotent or isinstance(e, aiohttp.ClientConnectorError)):
+                raise
+            delay = retry_delay(retry)
+        retry += 1
+        client.retries += 1
+        client.metrics.retried(method, url)
+        await asyncio.sleep(delay)
+
+async def api_request(client, method, url, ok=(200, 201, 204), headers=None, authenticated=True,
+                      handle=read_json_body, **kwargs):
+    """Запрос к API с проверкой статуса и повторами; возвращает handle(response), по умолчанию JSON.
+
+    headers добавляются к заголовкам авторизации, которые берутся заново на каждую попытку.
+    """
+    async def attempt():
+        request_headers = {**(client.headers if authenticated else {}), **(headers or {})}
+        async with client.session.request(method, url, headers=request_headers, **kwargs) as response:
+            await check_response(response, ok)
+            return await handle(response)
+    return await with_retries(client, method, url, attempt, authenticated)
+
+def report_retries(client):
+    if client.retries:
+        print(f"Повторено запросов: {client.retries}, "
+              f"лимит одновременных запросов снижался {client.limiter.decreases} раз до {int(client.limiter.limit)}")
+
+async def fetch_data(client, url):
+    return await api_request(client, 'GET', url)
+
+async def fetch_reference(client, url):
+    """GET справочника через кэш клиента: за прогон каждый URL запрашивается один раз."""
+    return await client.refs.get(url, lambda: fetch_data(client, url))
+
+async def post_data(client, url, payload):
+    return await api_request(client, 'POST', url, authenticated=False, json=payload)
+
+async def post_with_headers_data(client, url, payload):
+    return await api_request(client, 'POST', url, json=payload)
+  
+async def patch_data(client, url, payload):
+    return await api_request(client, 'PATCH', url, json=payload)
+
+async def fetch_and_save_file(client, url, snapshot, name, manifest=None):
+    # В инкрементальном режиме файл не скачивается, если сервер ответил 304,
+    # а файл с прежним содержимым снимок не перезаписывает
+    cached = manifest.previous.get('files', {}).get(url) if manifest is not None else None
+    if not snapshot.has_list_file(name):
+        cached = None
+    async def attempt():
+        headers = {**client.headers, **conditional_headers(cached)}
+        async with client.session.get(url, headers=headers) as response:
+            # Проверяем, что запрос был успешным
+            await check_response(response, ok=(200, 304) if cached else (200,))
+            if response.status == 304:
+                manifest.current['files'][url] = cached
+                manifest.reused += 1
+                return
+            # Файл появляется в снимке только после успешной записи, при обрыве остаётся прошлая копия
+            # и скачивание повторяется с начала
+            with snapshot.list_file(name) as file:
+                file_hash = await stream_normalized_lines(response, file)
+            if manifest is not None:
+                manifest.current['files'][url] = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'hash': file_hash
+                }
+    try:
+        await with_retries(client, 'GET', url, attempt)
+    except ApiError as e:
+        # Без файла снимок неполный: статический список восстановился бы пустым, поэтому бекап прерываем
+        print(f"Список {name} не скачан: {e}")
+        raise
+
+async def stream_normalized_lines(response, file):
+    """Потоково пишет тело ответа в файл: строки без лишних пробелов, без пустых строк.
+
+    Память не зависит от размера списка: в ней только текущий кусок и незавершённая строка.
+    Возвращает sha256 записанного содержимого.
+    """
+    decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+    file_hash = hashlib.sha256()
+    tail = ''
+    first = True
+
+    def write_lines(lines):
+        nonlocal first
+        for line in lines:
+            line = line.strip()
+            if line:
+                # Разделитель перед строкой, а не после: в конце файла нет перевода строки, как и раньше
+                text = line if first else f"\n{line}"
+                first = False
+                file.write(text)
+                file_hash.update(text.encode('utf-8'))
+
+    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+        lines = (tail + decoder.decode(chunk)).splitlines(keepends=True)
+        # Последняя строка без перевода строки может продолжиться в следующем куске
+        tail = lines.pop() if lines and lines[-1].splitlines() == [lines[-1]] else ''
+        write_lines(lines)
+    write_lines((tail + decoder.decode(b'', final=True)).splitlines())
+    return file_hash.hexdigest()
+
+async def get_headers(client,user,password):
+    """Вход в тенант: дальше все запросы клиента идут с актуальным токеном из client.auth."""
+    client.auth = AuthManager(client, user, password)
+    await client.auth.ensure_fresh()
+    return client.headers
 
 def read_json(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
         data = json.load(file)
     return data
 
-def find_key_by_value(dictionary, target_value):
-    for key, value in dictionary.items():
-        if value == target_value:
-            return key
+def write_json(file_path, data):
+    """Пишет JSON в формате бекапа; файл с тем же содержимым не перезаписывается."""
+    content = json.dumps(data, indent=4, ensure_ascii=False)
+    if os.path.exists(file_path):
+        with open(file_path, 'r', encoding='utf-8') as file:
+            if file.read() == content:
+                return
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write(content)
+
+def content_hash(data):
+    """Стабильный хэш JSON-совместимых данных для сравнения со снимком."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+class ReferenceLookupError(LookupError):
+    """Имени нет в справочнике тенанта или оно встречается в нём несколько раз."""
+
+class NameIndex:
+    """Двусторонний индекс имя <-> id одного справочника.
+
+    Строится один раз на справочник, поиск в обе стороны за O(1). Поиск по отсутствующему
+    или повторяющемуся имени поднимает ReferenceLookupError вместо None или первого совпадения.
+    """
+    def __init__(self, id_to_name, kind):
+        self.kind = kind
+        self.id_to_name = id_to_name
+        self.name_to_id = {}  # Только однозначные имена
+        self.duplicates = {}  # Имя -> все его id
+        for id, name in id_to_name.items():
+            if name in self.duplicates:
+                self.duplicates[name].append(id)
+            elif name in self.name_to_id:
+                self.duplicates[name] = [self.name_to_id.pop(name), id]
+            else:
+                self.name_to_id[name] = id
+
+    def id_of(self, name):
+        if name in self.name_to_id:
+            return self.name_to_id[name]
+        if name in self.duplicates:
+            ids = ', '.join(str(id) for id in self.duplicates[name])
+            raise ReferenceLookupError(f"{self.kind} '{name}': несколько объектов с таким именем (id {ids})")
+        raise ReferenceLookupError(f"{self.kind} '{name}': нет в тенанте")
+
+    def name_of(self, id):
+        return self.id_to_name.get(id)
+
+async def get_name_index(client, url, kind, paged=False):
+    """Индекс имя <-> id справочника по URL; строится один раз и кэшируется вместе со справочником.
+    paged - справочник большой и запрашивается по страницам."""
+    async def build():
+        response_data = await fetch_pages(client, url) if paged else await fetch_reference(client, url)
+        return NameIndex({item['id']: item['name'] for item in response_data['items']}, kind)
+    return await client.refs.get((url, 'index'), build)
+
+
+'''Формат снимка'''
+# Файлы снимка в каталоге backup (формат dir, он же формат экспорта)
+SNAPSHOT_FILES = {
+    'templates': 'templates.json',
+    'template_rules': 'template_rules.json',
+    'policy_rules': 'policy_rules.json',
+    'user_actions': 'user_actions.json',
+    'global_lists': 'global_lists/global_lists.json',
+}
+# Сколько символов списка кладётся в одну запись архива
+ARCHIVE_LIST_CHUNK = 1024 * 1024
+# Каталог хранилища снимков (формат store), общий для всех тенантов
+STORE_ROOT = 'store'
+
+class MissingListFileError(LookupError):
+    """Статического списка нет в снимке (его файл не сохранился). Это не то же, что пустой список:
+    восстановленный вместо него пустой список затёр бы список в тенанте."""
+
+def dumps_array_item(item):
+    """Элемент массива с тем же отступом, что даёт json.dump(..., indent=4) для всего массива."""
+    return '    ' + json.dumps(item, indent=4, ensure_ascii=False).replace('\n', '\n    ')
+
+def replace_if_changed(part_path, path):
+    """Переносит готовый .part на место файла; файл с тем же содержимым не перезаписывается."""
+    if os.path.exists(path) and filecmp.cmp(part_path, path, shallow=False):
+        os.remove(part_path)
+    else:
+        os.replace(part_path, path)
+
+class JsonArrayWriter:
+    """Пишет JSON-массив по одному элементу, не держа весь массив в памяти."""
+    def __init__(self, path):
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.count = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(self.part_path, 'w', encoding='utf-8')
+        self.file.write('[')
+
+    def append(self, item):
+        self.file.write(('\n' if self.count == 0 else ',\n') + dumps_array_item(item))
+        self.count += 1
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def close(self):
+        self.file.write('\n]' if self.count else ']')
+        self.file.close()
+        replace_if_changed(self.part_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Недописанный файл не должен заменить прошлую копию
+            self.file.close()
+            os.remove(self.part_path)
+
+class ListFileWriter:
+    """Текстовый файл списка, который появляется на месте только после успешной записи."""
+    def __init__(self, path):
+        self.path = path
+        self.part_path = f"{path}.part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(self.part_path, 'w', encoding='utf-8')
+
+    def write(self, text):
+        self.file.write(text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None:
+            replace_if_changed(self.part_path, self.path)
+        else:
+            os.remove(self.part_path)
+
+class DirectorySnapshot:
+    """Снимок в виде каталога backup с JSON-файлами и файлами списков."""
+    format = 'dir'
+
+    def __init__(self, root='backup'):
+        self.root = root
+
+    def path(self, kind):
+        return os.path.join(self.root, SNAPSHOT_FILES[kind])
+
+    def records(self, kind):
+        return JsonArrayWriter(self.path(kind))
+
+    def list_file(self, name):
+        return ListFileWriter(self.list_file_path(name))
+
+    def list_file_path(self, name):
+        return os.path.join(self.root, 'global_lists', name)
+
+    def has_list_file(self, name):
+        return os.path.exists(self.list_file_path(name))
+
+    def exists(self):
+        return os.path.exists(self.path('templates'))
+
+    def read(self, kind):
+        return read_json(self.path(kind))
+
+    def close(self):
+        pass
+
+class ArchiveListWriter:
+    """Файл списка внутри архива: текст режется на записи по ARCHIVE_LIST_CHUNK символов.
+
+    Пока список скачивается, текст копится во временном файле и попадает в архив только после
+    успешной записи: оборванная попытка, которую повторит with_retries, не оставит в архиве
+    половину списка.
+    """
+    def __init__(self, snapshot, name):
+        self.snapshot = snapshot
+        self.name = name
+        self.file = tempfile.TemporaryFile('w+', encoding='utf-8')
+
+    def write(self, text):
+        self.file.write(text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.file.seek(0)
+                for text in iter(lambda: self.file.read(ARCHIVE_LIST_CHUNK), ''):
+                    self.snapshot.write_record('list_file', {'name': self.name, 'text': text})
+                self.snapshot.list_files.append(self.name)
+        finally:
+            self.file.close()
+
+class ArchiveRecordWriter:
+    """Записи одного вида в архиве; интерфейс как у JsonArrayWriter."""
+    def __init__(self, snapshot, kind):
+        self.snapshot = snapshot
+        self.kind = kind
+
+    def append(self, item):
+        self.snapshot.write_record(self.kind, item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+class ArchiveSnapshot:
+    """Снимок одним файлом: записи NDJSON в сжатом потоке (gzip или zstd) и индекс рядом.
+
+    Каждая строка архива - {"kind": ..., "data": ...}; записи пишутся по мере получения.
+    Файлы списков хранятся кусками в записях вида list_file. Индекс snapshot.index.json
+    содержит формат, сжатие, число записей каждого вида и хэш архива.
+    """
+    format = 'archive'
+    extensions = {'gzip': 'gz', 'zstd': 'zst'}
+
+    def __init__(self, root='backup', compression='gzip'):
+        self.root = root
+        self.index_path = os.path.join(root, 'snapshot.index.json')
+        if os.path.exists(self.index_path):
+            compression = read_json(self.index_path)['compression']
+        if compression == 'zstd' and zstandard is None:
+            raise RuntimeError('Для сжатия zstd нужен пакет zstandard (pip install zstandard)')
+        self.compression = compression
+        self.path = os.path.join(root, f"snapshot.ndjson.{self.extensions[compression]}")
+        self.stream = None
+        self.counts = {}
+        self.list_files = []
+        self._records = None
+        self._tmp_dir = None
+
+    def _open(self, path, mode):
+        if self.compression == 'zstd':
+            return zstandard.open(path, mode, encoding='utf-8')
+        return gzip.open(path, mode, encoding='utf-8')
+
+    def write_record(self, kind, data):
+        if self.stream is None:
+            os.makedirs(self.root, exist_ok=True)
+            self.stream = self._open(f"{self.path}.part", 'wt')
+        self.stream.write(json.dumps({'kind': kind, 'data': data}, ensure_ascii=False) + '\n')
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def records(self, kind):
+        return ArchiveRecordWriter(self, kind)
+
+    def list_file(self, name):
+        return ArchiveListWriter(self, name)
+
+    def has_list_file(self, name):
+        # Прошлую копию списка из архива не переносим, список всегда скачивается заново
+        return False
+
+    def exists(self):
+        return os.path.exists(self.index_path) and os.path.exists(self.path)
+
+    def _load(self):
+        """Один проход по архиву: записи раскладываются по видам, списки - во временный каталог."""
+        if self._records is not None:
+            return
+        self._records = {kind: [] for kind in SNAPSHOT_FILES}
+        # Списки, сохранённые целиком; у пустого списка записей нет, но в индексе он есть
+        self._stored_lists = set(read_json(self.index_path)['list_files'])
+        self._tmp_dir = tempfile.mkdtemp(prefix='snapshot_lists_')
+        with self._open(self.path, 'rt') as stream:
+            for line in stream:
+                record = json.loads(line)
+                if record['kind'] == 'list_file':
+                    with open(os.path.join(self._tmp_dir, record['data']['name']), 'a', encoding='utf-8') as file:
+                        file.write(record['data']['text'])
+                else:
+                    self._records.setdefault(record['kind'], []).append(record['data'])
+
+    def read(self, kind):
+        self._load()
+        return self._records[kind]
+
+    def list_file_path(self, name):
+        self._load()
+        path = os.path.join(self._tmp_dir, name)
+        if name not in self._stored_lists:
+            raise MissingListFileError(f"Файла списка {name} нет в архиве {self.path}")
+        if not os.path.exists(path):
+            # Пустой список в архиве не даёт ни одной записи
+            open(path, 'w').close()
+        return path
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+            os.replace(f"{self.path}.part", self.path)
+            archive_hash = hashlib.sha256()
+            with open(self.path, 'rb') as file:
+                for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    archive_hash.update(chunk)
+            write_json(self.index_path, {
+                'format': 'ndjson',
+                'compression': self.compression,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'sha256': archive_hash.hexdigest(),
+                'counts': self.counts,
+                'list_files': sorted(self.list_files),
+            })
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+def open_snapshot(snapshot_format='dir', compression='gzip', root='backup', store_root=STORE_ROOT, tenant=None,
+                  snapshot_id=None):
+    """Снимок в каталоге root или, для формата store, снимок тенанта tenant в хранилище store_root."""
+    if snapshot_format == 'archive':
+        return ArchiveSnapshot(root, compression)
+    if snapshot_format == 'store':
+        return StoreSnapshot(SnapshotStore(store_root), tenant, root, snapshot_id)
+    return DirectorySnapshot(root)
+
+def export_snapshot(source, target):
+    """Переносит снимок из одного формата в другой, например архив в привычный каталог backup."""
+    for kind in SNAPSHOT_FILES:
+        with target.records(kind) as records:
+            records.extend(source.read(kind))
+    for item in source.read('global_lists'):
+        if item['list_type'] == 'STATIC':
+            with open(source.list_file_path(item['list_name']), 'r', encoding='utf-8') as src, \
+                    target.list_file(item['list_name']) as dst:
+                shutil.copyfileobj(src, dst)
+    target.close()
+    source.close()
+
+
+'''Хранилище снимков'''
+# Записи этих видов хранятся без правил, каждое правило - отдельным объектом
+STORE_SPLIT_KINDS = ('template_rules', 'policy_rules')
+# Объекты моложе этого GC не удаляет: их мог только что записать или переиспользовать идущий бекап
+STORE_GC_GRACE = 60 * 60
+
+class SnapshotStore:
+    """Хранилище снимков с дедупликацией по содержимому.
+
+    objects/ - объекты по sha256 содержимого, сжатые gzip: записи снимков, отдельные правила
+    и файлы списков. Одинаковый объект хранится один раз, сколько бы снимков и тенантов на него ни ссылалось.
+    snapshots/<тенант>/<id>.json - манифест снимка: хэши записей каждого вида и файлов списков.
+    pending/<тенант>.json - файлы списков недописанного бекапа, чтобы --resume не качал их заново.
+    pending/<тенант>.objects - хэши записей и правил недописанного бекапа: манифеста у них ещё нет,
+    а GC не должен их удалить, сколько бы бекап ни шёл.
+    """
+    def __init__(self, root=STORE_ROOT):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.snapshots_dir = os.path.join(root, 'snapshots')
+        self.pending_dir = os.path.join(root, 'pending')
+        self.tmp_dir = os.path.join(root, 'tmp')
+
+    def object_path(self, object_hash):
+        return os.path.join(self.objects_dir, object_hash[:2], object_hash[2:])
+
+    def temp_file(self):
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(fd)
+        return path
+
+    def commit(self, part_path, object_hash):
+        """Переносит готовый сжатый объект на место. Возвращает True, если такого объекта ещё не было."""
+        path = self.object_path(object_hash)
+        if os.path.exists(path):
+            os.remove(part_path)
+            # Объект снова нужен: GC не должен удалить его, пока манифест ещё не записан
+            os.utime(path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(part_path, path)
+        return True
+
+    def put(self, data):
+        """Сохраняет байты; возвращает (хэш, новый ли объект)."""
+        object_hash = hashlib.sha256(data).hexdigest()
+        path = self.object_path(object_hash)
+        if os.path.exists(path):
+            os.utime(path)
+            return object_hash, False
+        part_path = self.temp_file()
+        with gzip.open(part_path, 'wb', compresslevel=6) as file:
+            file.write(data)
+        return object_hash, self.commit(part_path, object_hash)
+
+    def read(self, object_hash):
+        with gzip.open(self.object_path(object_hash), 'rb') as file:
+            return file.read()
+
+    def put_json(self, data):
+        return self.put(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    def read_json(self, object_hash):
+        return json.loads(self.read(object_hash))
+
+    def snapshots(self, tenant=None):
+        """Манифесты снимков (все или одного тенанта), от старых к новым."""
+        manifests = []
+        tenants = [tenant] if tenant is not None else \
+            (os.listdir(self.snapshots_dir) if os.path.isdir(self.snapshots_dir) else [])
+        for name in tenants:
+            directory = os.path.join(self.snapshots_dir, name)
+            if os.path.isdir(directory):
+                manifests += [read_json(os.path.join(directory, file_name))
+                              for file_name in os.listdir(directory) if file_name.endswith('.json')]
+        return sorted(manifests, key=lambda manifest: (manifest['created'], manifest['id']))
+
+    def find(self, snapshot_id=None, tenant=None):
+        """Снимок по id (у любого тенанта) или последний снимок тенанта; None, если такого нет."""
+        manifests = self.snapshots(tenant)
+        if snapshot_id is not None:
+            manifests = [manifest for manifest in manifests if manifest['id'] == snapshot_id]
+        return manifests[-1] if manifests else None
+
+    def manifest_path(self, tenant, snapshot_id):
+        return os.path.join(self.snapshots_dir, tenant, f'{snapshot_id}.json')
+
+    def save_manifest(self, manifest):
+        path = self.manifest_path(manifest['tenant'], manifest['id'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.part', 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, indent=4, ensure_ascii=False)
+        os.replace(f'{path}.part', path)
+
+    def new_snapshot_id(self, tenant):
+        snapshot_id = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        suffix = 1
+        while os.path.exists(self.manifest_path(tenant, snapshot_id if suffix == 1 else f'{snapshot_id}-{suffix}')):
+            suffix += 1
+        return snapshot_id if suffix == 1 else f'{snapshot_id}-{suffix}'
+
+    def pending_path(self, tenant):
+        return os.path.join(self.pending_dir, f'{tenant}.json')
+
+    def read_pending(self, tenant):
+        path = self.pending_path(tenant)
+        return read_json(path) if os.path.exists(path) else {}
+
+    def write_pending(self, tenant, list_files):
+        os.makedirs(self.pending_dir, exist_ok=True)
+        path = self.pending_path(tenant)
+        with open(f'{path}.part', 'w', encoding='utf-8') as file:
+            json.dump(list_files, file, ensure_ascii=False)
+        os.replace(f'{path}.part', path)
+
+    def pending_objects_path(self, tenant):
+        return os.path.join(self.pending_dir, f'{tenant}.objects')
+
+    def open_pending_objects(self, tenant):
+        """Файл, в который бекап дописывает хэши своих объектов по строке на объект."""
+        os.makedirs(self.pending_dir, exist_ok=True)
+        return open(self.pending_objects_path(tenant), 'a', encoding='utf-8')
+
+    def clear_pending(self, tenant):
+        for path in (self.pending_path(tenant), self.pending_objects_path(tenant)):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def prune(self, tenant, keep_last=None, keep_daily=None):
+        """Удаляет манифесты снимков тенанта, не попавшие под политику хранения:
+        keep_last последних снимков и по последнему снимку за каждый из keep_daily последних дней.
+        Без политики ничего не удаляется. Возвращает удалённые манифесты; объекты освобождает gc()."""
+        if keep_last is None and keep_daily is None:
+            return []
+        manifests = self.snapshots(tenant)[::-1]
+        keep = {manifest['id'] for manifest in manifests[:keep_last or 0]}
+        days = []
+        for manifest in manifests:
+            day = manifest['created'][:10]
+            if day not in days:
+                days.append(day)
+                if len(days) > (keep_daily or 0):
+                    break
+                keep.add(manifest['id'])
+        removed = [manifest for manifest in manifests if manifest['id'] not in keep]
+        for manifest in removed:
+            os.remove(self.manifest_path(tenant, manifest['id']))
+        return removed
+
+    def live_objects(self):
+        """Хэши всех объектов, на которые ссылаются манифесты и недописанные бекапы."""
+        live = set()
+        for manifest in self.snapshots():
+            live.update(manifest['list_files'].values())
+            for kind, hashes in manifest['records'].items():
+                for object_hash in hashes:
+                    if object_hash in live:
+                        continue
+                    live.add(object_hash)
+                    if kind in STORE_SPLIT_KINDS:
+                        entry = self.read_json(object_hash)
+                        if entry is not None:
+                            live.update(entry['rules'])
+        if os.path.isdir(self.pending_dir):
+            for file_name in os.listdir(self.pending_dir):
+                path = os.path.join(self.pending_dir, file_name)
+                if file_name.endswith('.objects'):
+                    with open(path, 'r', encoding='utf-8') as file:
+                        live.update(line.strip() for line in file)
+                elif file_name.endswith('.json'):
+                    live.update(read_json(path).values())
+        return live
+
+    def gc(self, grace=STORE_GC_GRACE):
+        """Удаляет объекты, на которые не ссылается ни один снимок. Возвращает (число объектов, байт)."""
+        live = self.live_objects()
+        deadline = time.time() - grace
+        removed = freed = 0
+        for directory in (self.objects_dir, self.tmp_dir):
+            if not os.path.isdir(directory):
+                continue
+            for dir_path, _, file_names in os.walk(directory):
+                for file_name in file_names:
+                    path = os.path.join(dir_path, file_name)
+                    object_hash = os.path.basename(dir_path) + file_name
+                    stat = os.stat(path)
+                    if (directory == self.tmp_dir or object_hash not in live) and stat.st_mtime < deadline:
+                        os.remove(path)
+                        removed += 1
+                        freed += stat.st_size
+        return removed, freed
+
+    def size(self):
+        total = 0
+        for dir_path, _, file_names in os.walk(self.objects_dir):
+            total += sum(os.path.getsize(os.path.join(dir_path, file_name)) for file_name in file_names)
+        return total
+
+class StoreListWriter:
+    """Файл списка в хранилище: сжимается во временный файл с подсчётом хэша и становится объектом
+    после успешной записи; если такое содержимое уже есть, второй копии не появляется."""
+    def __init__(self, snapshot, name):
+        self.snapshot = snapshot
+        self.name = name
+        self.hash = hashlib.sha256()
+        self.part_path = snapshot.store.temp_file()
+        self.file = gzip.open(self.part_path, 'wb', compresslevel=6)
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.hash.update(data)
+        self.file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None:
+            object_hash = self.hash.hexdigest()
+            self.snapshot.count_object(object_hash, self.snapshot.store.commit(self.part_path, object_hash))
+            self.snapshot.add_list_file(self.name, object_hash)
+        else:
+            os.remove(self.part_path)
+
+class StoreRecordWriter:
+    """Записи одного вида в снимке хранилища; интерфейс как у JsonArrayWriter."""
+    def __init__(self, snapshot, kind):
+        self.snapshot = snapshot
+        self.kind = kind
+        snapshot.records_out[kind] = []
+
+    def append(self, item):
+        self.snapshot.add_record(self.kind, item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+class StoreSnapshot:
+    """Снимок в хранилище SnapshotStore.
+
+    Читается снимок snapshot_id или последний снимок тенанта (base); пишется новый снимок тенанта,
+    манифест которого появляется в close() только после успешного бекапа. Правила записей
+    template_rules и policy_rules хранятся по одному, так что изменение одного правила добавляет
+    в хранилище только его и маленькую запись шаблона. Списки, не скачанные заново (сервер ответил 304),
+    берутся из прошлого снимка. root - рабочий каталог тенанта (журнал, манифест инкрементального бекапа).
+    """
+    format = 'store'
+
+    def __init__(self, store, tenant, root='backup', snapshot_id=None):
+        self.store = store
+        self.tenant = tenant
+        self.root = root
+        self.base = store.find(snapshot_id, None if snapshot_id is not None else tenant)
+        if snapshot_id is not None and self.base is None:
+            raise RuntimeError(f'В хранилище {store.root} нет снимка {snapshot_id}')
+        self.records_out = {}
+        # Списки, записанные в этом (или прерванном прошлом) бекапе
+        self.list_files = store.read_pending(tenant)
+        self.new_objects = 0
+        self.new_bytes = 0
+        self._pending_objects = None
+        self._tmp_dir = None
+
+    def count_object(self, object_hash, new):
+        if new:
+            self.new_objects += 1
+            self.new_bytes += os.path.getsize(self.store.object_path(object_hash))
+
+    def put(self, data):
+        object_hash, new = self.store.put_json(data)
+        self.count_object(object_hash, new)
+        # Объект уже лежит в хранилище, но манифест появится только в конце бекапа: до тех пор его держит pending
+        if self._pending_objects is None:
+            self._pending_objects = self.store.open_pending_objects(self.tenant)
+        self._pending_objects.write(f'{object_hash}\n')
+        self._pending_objects.flush()
+        return object_hash
+
+    def add_record(self, kind, item):
+        if kind in STORE_SPLIT_KINDS and item is not None:
+            item = {**item, 'rules': [self.put(rule) for rule in item['rules']]}
+        self.records_out[kind].append(self.put(item))
+
+    def add_list_file(self, name, object_hash):
+        self.list_files[name] = object_hash
+        self.store.write_pending(self.tenant, self.list_files)
+
+    def records(self, kind):
+        return StoreRecordWriter(self, kind)
+
+    def list_file(self, name):
+        return StoreListWriter(self, name)
+
+    def has_list_file(self, name):
+        return name in self.list_files or (self.base is not None and name in self.base['list_files'])
+
+    def exists(self):
+        return self.base is not None
+
+    def read(self, kind):
+        if self.base is None:
+            raise RuntimeError(f'В хранилище {self.store.root} нет снимков тенанта {self.tenant}')
+        entries = []
+        for object_hash in self.base['records'].get(kind, []):
+            entry = self.store.read_json(object_hash)
+            if kind in STORE_SPLIT_KINDS and entry is not None:
+                entry['rules'] = [self.store.read_json(rule_hash) for rule_hash in entry['rules']]
+            entries.append(entry)
+        return entries
+
+    def list_file_path(self, name):
+        """Файл списка распаковывается во временный каталог, который удаляется в close()."""
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix='snapshot_lists_')
+        path = os.path.join(self._tmp_dir, name)
+        if not os.path.exists(path):
+            # У пустого списка тоже есть объект, так что отсутствие ссылки - потерянный файл, а не пустой список
+            object_hash = self.base['list_files'].get(name) if self.base is not None else None
+            if object_hash is None:
+                snapshot_id = self.base['id'] if self.base is not None else 'тенанта ' + str(self.tenant)
+                raise MissingListFileError(f"Файла списка {name} нет в снимке {snapshot_id} хранилища {self.store.root}")
+            with open(path, 'wb') as file, gzip.open(self.store.object_path(object_hash), 'rb') as source:
+                shutil.copyfileobj(source, file)
+        return path
+
+    def close(self):
+        if self._pending_objects is not None:
+            self._pending_objects.close()
+            self._pending_objects = None
+        if self.records_out:
+            self.commit()
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def commit(self):
+        records = dict(self.base['records']) if self.base is not None else {}
+        records.update(self.records_out)
+        list_files = {}
+        # Статические списки этого снимка: скачанные заново или, если не скачивались, из прошлого снимка
+        for object_hash in records.get('global_lists', []):
+            item = self.store.read_json(object_hash)
+            name = item['list_name']
+            if item['list_type'] != 'STATIC':
+                continue
+            if name in self.list_files:
+                list_files[name] = self.list_files[name]
+            elif self.base is not None and name in self.base['list_files']:
+                list_files[name] = self.base['list_files'][name]
+        manifest = {
+            'id': self.store.new_snapshot_id(self.tenant),
+            'tenant': self.tenant,
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'parent': self.base['id'] if self.base is not None else None,
+            'counts': {kind: len(hashes) for kind, hashes in records.items()},
+            'new_objects': self.new_objects,
+            'new_bytes': self.new_bytes,
+            'records': records,
+            'list_files': list_files,
+        }
+        self.store.save_manifest(manifest)
+        self.store.clear_pending(self.tenant)
+        self.id = manifest['id']
+        print(f"Снимок {manifest['id']} сохранён в {self.store.root}: новых объектов {self.new_objects}, "
+              f"{self.new_bytes / 1024:.0f} КБ")
+
+def print_snapshots(store_root=STORE_ROOT, tenant=None):
+    store = SnapshotStore(store_root)
+    for manifest in store.snapshots(tenant):
+        counts = ', '.join(f'{kind} {count}' for kind, count in manifest['counts'].items())
+        print(f"{manifest['tenant']:<20}{manifest['id']:<22}{manifest['created']:<27}{counts}")
+    print(f"Хранилище {store_root} занимает {store.size() / 1024 ** 2:.1f} МБ")
+
+def prune_store(store_root=STORE_ROOT, keep_last=None, keep_daily=None):
+    """Применяет политику хранения ко всем тенантам хранилища и удаляет ставшие ненужными объекты."""
+    store = SnapshotStore(store_root)
+    tenants = os.listdir(store.snapshots_dir) if os.path.isdir(store.snapshots_dir) else []
+    removed = sum(len(store.prune(tenant, keep_last, keep_daily)) for tenant in tenants)
+    objects, freed = store.gc()
+    print(f"Удалено снимков: {removed}, объектов: {objects} ({freed / 1024 ** 2:.1f} МБ); "
+          f"хранилище занимает {store.size() / 1024 ** 2:.1f} МБ")
+
+
+'''Инкрементальный бекап'''
+MANIFEST_FILE = "manifest.json"
+
+class BackupManifest:
+    """Манифест последнего снимка для инкрементального бекапа.
+
+    Хранит валидаторы HTTP (ETag/Last-Modified) вместе с телами ответов, хэши файлов
+    списков и отпечатки шаблонов и политик. По ним следующий прогон решает,
+    какие объекты можно не перезапрашивать и не перезаписывать.
+    Манифест пишется после каждого успешного бекапа, а читается только в режиме --incremental.
+    Тела ответов тоже запоминаются только в режиме --incremental: иначе они весь прогон лежали бы
+    в памяти и удваивали бы снимок на диске. Первый инкрементальный прогон после полного
+    запрашивает ответы целиком, а хэши файлов списков и отпечатки берёт из манифеста полного бекапа.
+    """
+    def __init__(self, path, previous=None, keep_bodies=False):
+        self.path = path
+        self.previous = previous or {}
+        self.keep_bodies = keep_bodies
+        self.current = {'http': {}, 'files': {}, 'template_rules': {}, 'policy_rules': {}}
+        # Записи прошлого снимка по имени: из них берутся неизменившиеся правила
+        self.previous_entries = {'template_rules': {}, 'policy_rules': {}}
+        self.reused = 0
+
+    @classmethod
+    def load(cls, incremental, snapshot):
+        path = os.path.join(snapshot.root, MANIFEST_FILE)
+        if not incremental or not os.path.exists(path) or not snapshot.exists():
+            return cls(path, keep_bodies=incremental)
+        manifest = cls(path, read_json(path), keep_bodies=True)
+        for kind, name_key in (('template_rules', 'template_name'), ('policy_rules', 'policy_name')):
+            manifest.previous_entries[kind] = {entry[name_key]: entry for entry in snapshot.read(kind) if entry is not None}
+        return manifest
+
+    def save(self):
+        write_json(self.path, self.current)
+
+    def reuse_entry(self, kind, id, name, fingerprint):
+        """Запись прошлого снимка, если отпечаток объекта не изменился; иначе None.
+
+        Возвращает пару (найдено, запись): запись может быть None, если у объекта не было правил.
+        """
+        previous = self.previous.get(kind, {}).get(id)
+        if previous is None or previous['fingerprint'] != fingerprint:
+            return False, None
+        if not previous['has_rules']:
+            return True, None
+        entry = self.previous_entries[kind].get(name)
+        return entry is not None, entry
+
+    def remember_entry(self, kind, id, fingerprint, entry):
+        self.current[kind][id] = {'fingerprint': fingerprint, 'has_rules': entry is not None}
+
+def conditional_headers(cached):
+    """Валидаторы прошлого ответа для условного GET."""
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    return headers
+
+async def fetch_conditional(client, url, manifest):
+    """GET с If-None-Match/If-Modified-Since по манифесту; на 304 возвращает тело из манифеста."""
+    if manifest is None:
+        return await fetch_data(client, url)
+    cached = manifest.previous.get('http', {}).get(url)
+
+    async def handle(response):
+        if response.status == 304:
+            manifest.current['http'][url] = cached
+            return cached['body']
+        response_data = await read_json_body(response)
+        etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        # Тело сохраняем только для инкрементального бекапа и только если сервер дал валидатор,
+        # иначе оно не пригодится
+        if manifest.keep_bodies and (etag or last_modified):
+            manifest.current['http'][url] = {'etag': etag, 'last_modified': last_modified, 'body': response_data}
+        return response_data
+    return await api_request(client, 'GET', url, ok=(200, 304) if cached else (200,),
+                             headers=conditional_headers(cached), handle=handle)
+
+async def fetch_pages(client, url, params=None, manifest=None):
+    """Весь листинг по страницам limit/offset; возвращает {'items': [...]}, как обычный ответ.
+
+    Если сервер сообщает total, страницы запрашиваются, пока не набрано total: страница может быть
+    короче limit, когда сервер урезает его до своего максимума. Без total листинг кончается на неполной
+    странице. Сервер без пагинации отдаёт всё сразу (больше limit) или снова ту же страницу - на этом
+    листинг кончается в любом случае.
+    Каждая страница - отдельный условный GET, так что инкрементальный бекап работает и постранично.
+    """
+    items = []
+    seen = set()
+    offset = 0
+    while True:
+        query = urllib.parse.urlencode({**(params or {}), 'limit': client.page_size, 'offset': offset})
+        page = await fetch_conditional(client, f"{url}?{query}", manifest) or {}
+        page_items = page.get('items', [])
+        new_items = [item for item in page_items if item['id'] not in seen]
+        items.extend(new_items)
+        seen.update(item['id'] for item in new_items)
+        total = page.get('total')
+        if not new_items or (len(items) >= total if total is not None else len(page_items) != client.page_size):
+            return {'items': items}
+        offset += len(page_items)
+
+async def get_references_fingerprint(client):
+    """Хэш справочников действий и списков: их имена попадают в сохранённые правила."""
+    async def build():
+        actions_list = await get_actions_name(client)
+        dict_names = await get_global_lists_names(client)
+        return content_hash([actions_list, dict_names])
+    return await client.refs.get('references_fingerprint', build)
+
+
+'''Контрольные точки'''
+# Журналы прерванных прогонов в каталоге снимка; после успешного прогона удаляются
+BACKUP_JOURNAL = "backup.journal"
+RESTORE_JOURNAL = "restore.journal"
+
+class CheckpointJournal:
+    """Журнал завершённых единиц работы: создано действие, загружен список, пропатчено правило и т.д.
+
+    Пишется построчно (JSONL) сразу по завершении единицы, поэтому переживает падение процесса.
+    С resume прошлый журнал читается и готовые единицы пропускаются, без него журнал начинается заново.
+    После успешного прогона журнал удаляется.
+    """
+    def __init__(self, path, resume=False, read_only=False):
+        self.path = path
+        self.completed = {}
+        if resume and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Строка, недописанная при падении: эту единицу просто сделаем заново
+                        continue
+                    self.completed[entry['unit']] = entry.get('data')
+        self.resumed = len(self.completed)
+        self.file = None
+        if not read_only:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def done(self, unit):
+        return unit in self.completed
+
+    def get(self, unit):
+        return self.completed.get(unit)
+
+    def record(self, unit, data=None):
+        self.completed[unit] = data
+        if self.file is not None:
+            self.file.write(json.dumps({'unit': unit, 'data': data}, ensure_ascii=False) + '\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def finish(self):
+        """Прогон завершён успешно, продолжать нечего."""
+        self.file.close()
+        os.remove(self.path)
+
+
+'''Конвейер записи'''
+async def run_ordered(items, worker, consume, window=None):
+    """Запускает worker для элементов по порядку, не больше window одновременно.
+
+    Результаты отдаются в consume в исходном порядке, как только готовы все предыдущие,
+    поэтому файл пишется по мере работы, а в памяти держится не больше window результатов.
+    """
+    window = window or PIPELINE_WINDOW
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(asyncio.ensure_future(worker(item)))
+            if len(pending) >= window:
+                consume(await pending.popleft())
+        while pending:
+            consume(await pending.popleft())
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+
+
+'''Листинг правил'''
+# Поля листинга, которые меняются вместе с правилом. Если они есть у всех кандидатов, отпечаток
+# листинга покрывает и содержимое правил; иначе детали правил перепроверяются условными GET
+RULE_VERSION_FIELDS = ('updated_at', 'modified_at', 'last_modified', 'version')
+
+def listing_tracks_changes(response_data):
+    return all(any(field in item for field in RULE_VERSION_FIELDS) for item in response_data['items'])
+
+def is_rule_candidate(rule):
+    """Может ли правило из листинга быть изменённым системным. Если нужных полей в листинге нет -
+    может, решит запрос деталей."""
+    return rule.get('has_overrides', True) and rule.get('is_system', True)
+
+async def fetch_rule_candidates(client, url, manifest=None):
+    """Листинг правил шаблона или политики, только кандидаты в бекап: детали запрашиваются лишь для них.
+
+    Сначала просим сервер отфильтровать изменённые правила (client.rules_filter). Если он фильтр
+    не принимает (400/422), листинги этого клиента дальше идут без фильтра. Молча проигнорированный
+    фильтр не страшен: правила без изменений отсеиваются по полям листинга.
+    """
+    rules_filter = client.rules_filter
+    listing = None
+    if rules_filter:
+        try:
+            listing = await fetch_pages(client, url, rules_filter, manifest)
+        except ApiError as e:
+            if e.status not in (400, 422):
+                raise
+            if client.rules_filter is rules_filter:
+                client.rules_filter = None
+                print("Сервер не принимает фильтр листинга правил, отбираем правила по полям листинга")
+    if listing is None:
+        listing = await fetch_pages(client, url, manifest=manifest)
+    return {'items': [rule for rule in listing['items'] if is_rule_candidate(rule)]}
 
 
 '''Получение шаблонов, правил из шаблонов'''
-async def get_template_name(id, headers, owner):
-    url = f"{url_backup_api}/config/policies/templates/{owner}/{id}"
-    response_data = await fetch_data(url, headers=headers)
+async def get_template_name(id, client, owner):
+    url = f"{client.api}/config/policies/templates/{owner}/{id}"
+    response_data = await fetch_reference(client, url)
     return response_data['name']
 
-async def get_user_templates(urlapi, headers):
-    url = f'{urlapi}/config/policies/templates/user'
-    response_data = await fetch_data(url, headers=headers)
-
-    result_list = []
-    
-    for item in response_data['items']:
-        response_data = await fetch_data(f"{url}/{item['id']}", headers=headers)
-        result_list.append(response_data)
-    list_for_save = []
-    for item in result_list:
-        template_based_name = await get_template_name(item['templates'][0], headers, 'vendor')
-        list_for_save.append({
-            'name': item['name'],
-            "has_user_rules": item["has_user_rules"],
-            "based_on_name": template_based_name 
-        }
-        )
-    os.makedirs("backup", exist_ok=True)
-    with open("backup/templates.json", 'w', encoding='utf-8') as file:
-        json.dump(list_for_save, file, indent=4, ensure_ascii=False)
-    return result_list    
-
-async def get_rules_for_template(item, headers):
+async def get_user_template(url, item, client, manifest=None):
+    """Детали одного пользовательского шаблона и его запись для templates.json."""
+    item = await fetch_conditional(client, f"{url}/{item['id']}", manifest)
+    template_based_name = await get_template_name(item['templates'][0], client, 'vendor')
+    return item, {
+        'name': item['name'],
+        "has_user_rules": item["has_user_rules"],
+        "based_on_name": template_based_name 
+    }
+
+async def get_rules_for_template(item, client, manifest=None):
     """Функция для сбора правил для одного шаблона."""
-    url = f"{url_backup_api}/config/policies/templates/user/{item['id']}/rules"
+    url = f"{client.api}/config/policies/templates/user/{item['id']}/rules"
     print(f"Собираем изменённые правила для шаблона {item['name']}...")
-    response_data = await fetch_data(url, headers=headers)
-    actions_list = await get_actions_name(headers)
-    dict_names = await get_global_lists_names(headers)
+    response_data = await fetch_rule_candidates(client, url, manifest)
+    actions_list = await get_actions_name(client)
+    dict_names = await get_global_lists_names(client)
+
+    if manifest is not None:
+        # Детали правил не запрашиваем, только если не изменились сам шаблон, справочники и список его правил,
+        # а по листингу видно, что не менялись и сами правила
+        fingerprint = content_hash([item, response_data, await get_references_fingerprint(client)])
+        found, entry = manifest.reuse_entry('template_rules', item['id'], item['name'], fingerprint) \
+            if listing_tracks_changes(response_data) else (False, None)
+        if found:
+            print(f"Шаблон {item['name']} не изменился с прошлого бекапа")
+            manifest.reused += 1
+        else:
+            entry = await collect_template_rules(item, client, response_data, actions_list, dict_names, manifest)
+        manifest.remember_entry('template_rules', item['id'], fingerprint, entry)
+        return entry
+    return await collect_template_rules(item, client, response_data, actions_list, dict_names)
+
+async def collect_template_rules(item, client, response_data, actions_list, dict_names, manifest=None):
+    """Запрашивает детали правил шаблона и оставляет изменённые системные правила.
+    С манифестом детали запрашиваются условными GET: неизменённое правило придёт ответом 304."""
     rules_for_template = []  # Список для хранения правил текущего шаблона
-    
-    for i in response_data['items']:
-        url = f"{url_backup_api}/config/policies/templates/user/{item['id']}/rules/{i['id']}"
-        url_ui = f"https://{creds['BACKUP_HOST']}/conf-scheme/user_policy/{item['id']}/rules/rule/{i['id']}"
-        response_data = await fetch_data(url, headers=headers)
+
+    # Детали правил запрашиваем параллельно, порядок сохраняется за счёт gather
+    urls = [f"{client.api}/config/policies/templates/user/{item['id']}/rules/{i['id']}" for i in response_data['items']]
+    rules_details = await asyncio.gather(*(fetch_conditional(client, url, manifest) for url in urls))
+
+    for i, response_data in zip(response_data['items'], rules_details):
+        url_ui = f"https://{client.host}/conf-scheme/user_policy/{item['id']}/rules/rule/{i['id']}"
 
         if response_data['has_overrides'] and response_data['is_system']:
             actions = [actions_list.get(id) for id in response_data['actions']]
-            params_with_list_names = replace_value_with_name(response_data['variables'], dict_names)
+            params_with_list_names = variables_with_list_names(response_data, dict_names, f"шаблона {item['name']}")
             rules_for_template.append({
                 'rule_name': response_data['name'],
                 'rule_link': url_ui,
@@ -147,8 +1798,8 @@ async def get_rules_for_template(item, headers):
     
     # Если у шаблона есть правила, возвращаем их
     if rules_for_template:
-        url_ui_template = f"https://{creds['BACKUP_HOST']}/conf-scheme/vendor_policy/{item['templates'][0]}"
-        template_based_name = await get_template_name(item['templates'][0], headers, 'vendor')
+        url_ui_template = f"https://{client.host}/conf-scheme/vendor_policy/{item['templates'][0]}"
+        template_based_name = await get_template_name(item['templates'][0], client, 'vendor')
         return {
             "template_name": item['name'],  # Имя шаблона
             "based_on_name": template_based_name, # На чём основан
@@ -157,54 +1808,85 @@ async def get_rules_for_template(item, headers):
             "rules": rules_for_template  # Список правил для этого шаблона
         }
 
-async def get_rules_template(user_templates, headers):
-    """Основная функция для сбора правил для всех шаблонов."""
-    json_data = user_templates
-    
-    # Запускаем задачи для каждого шаблона параллельно
-    tasks = [get_rules_for_template(item, headers) for item in json_data]
-    grouped_rules = await asyncio.gather(*tasks)
-
-    # Создаем директорию, если она не существует
-    os.makedirs("backup", exist_ok=True)
-
-    # Записываем данные в файл
-    with open("backup/template_rules.json", 'w', encoding='utf-8') as file:
-        json.dump(grouped_rules, file, indent=4, ensure_ascii=False)
+async def get_rules_template(client, snapshot, manifest=None, journal=None, selection=None):
+    """Основная функция для сбора шаблонов и правил для всех шаблонов.
+
+    Шаблон проходит путь детали -> правила -> запись в снимок независимо от остальных,
+    в памяти одновременно не больше PIPELINE_WINDOW шаблонов.
+    selection - ObjectSelection: шаблоны отбираются по листингу, до запроса деталей.
+    """
+    url = f'{client.api}/config/policies/templates/user'
+    response_data = await fetch_data(client, url)
+    items = [item for item in response_data['items'] if selection is None or selection.selected('templates', item)]
+
+    async def process(item):
+        unit = f"template:{item['id']}"
+        if journal is not None and journal.done(unit):
+            return tuple(journal.get(unit))
+        item, template_record = await get_user_template(url, item, client, manifest)
+        result = template_record, await get_rules_for_template(item, client, manifest)
+        if journal is not None:
+            journal.record(unit, result)
+        return result
+
+    with snapshot.records('templates') as templates_out, snapshot.records('template_rules') as rules_out:
+        def write(result):
+            template_record, rules_entry = result
+            templates_out.append(template_record)
+            # Шаблоны без изменённых правил в template_rules.json не пишем
+            if rules_entry is not None:
+                rules_out.append(rules_entry)
+                if selection is not None:
+                    selection.require_rules(rules_entry['rules'])
+
+        await run_ordered(items, process, write)
 
     print("Сбор правил для шаблонов завершён.")
 
 
 '''Получение политик, правил из политик'''
 
-async def get_user_policy(urlapi, headers):
-    url = f'{urlapi}/config/policies'
-    response_data = await fetch_data(url, headers=headers)
-
-    result_list = []
-    
-    for item in response_data['items']:
-        response_data = await fetch_data(f"{url}/{item['id']}", headers=headers)
-        result_list.append(response_data)
-
-    return result_list    
+async def get_user_policy(url, item, client, manifest=None, selection=None):
+    """Детали одной политики; если их уже запросил resolve_policy_templates, берутся из selection."""
+    details = selection.take_details('policies', item['id']) if selection is not None else None
+    if details is not None:
+        return details
+    return await fetch_conditional(client, f"{url}/{item['id']}", manifest)
 
-async def get_rules_for_policy(item,headers):
+async def get_rules_for_policy(item,client, manifest=None):
     """Функция для сбора правил для одного шаблона."""
-    url = f"{url_backup_api}/config/policies/{item['id']}/rules"
+    url = f"{client.api}/config/policies/{item['id']}/rules"
     print(f"Собираем изменённые правила для политики {item['name']}...")
-    response_data = await fetch_data(url, headers=headers)
-    actions_list = await get_actions_name(headers)
-    dict_names = await get_global_lists_names(headers)
+    response_data = await fetch_rule_candidates(client, url, manifest)
+    actions_list = await get_actions_name(client)
+    dict_names = await get_global_lists_names(client)
+
+    if manifest is not None:
+        fingerprint = content_hash([item, response_data, await get_references_fingerprint(client)])
+        found, entry = manifest.reuse_entry('policy_rules', item['id'], item['name'], fingerprint) \
+            if listing_tracks_changes(response_data) else (False, None)
+        if found:
+            print(f"Политика {item['name']} не изменилась с прошлого бекапа")
+            manifest.reused += 1
+        else:
+            entry = await collect_policy_rules(item, client, response_data, actions_list, dict_names, manifest)
+        manifest.remember_entry('policy_rules', item['id'], fingerprint, entry)
+        return entry
+    return await collect_policy_rules(item, client, response_data, actions_list, dict_names)
+
+async def collect_policy_rules(item, client, response_data, actions_list, dict_names, manifest=None):
+    """Запрашивает детали правил политики и оставляет изменённые системные правила, как collect_template_rules."""
     rules_for_policy = []  # Список для хранения правил текущего шаблона
-    
-    for i in response_data['items']:
-        url = f"{url_backup_api}/config/policies/{item['id']}/rules/{i['id']}"
-        url_ui = f"https://{creds['BACKUP_HOST']}/conf-scheme/application_policy/{item['id']}/rules/rule/{i['id']}"
-        response_data = await fetch_data(url, headers=headers)        
+
+    # Детали правил запрашиваем параллельно, порядок сохраняется за счёт gather
+    urls = [f"{client.api}/config/policies/{item['id']}/rules/{i['id']}" for i in response_data['items']]
+    rules_details = await asyncio.gather(*(fetch_conditional(client, url, manifest) for url in urls))
+
+    for i, response_data in zip(response_data['items'], rules_details):
+        url_ui = f"https://{client.host}/conf-scheme/application_policy/{item['id']}/rules/rule/{i['id']}"
         if response_data['has_overrides'] and response_data['is_system']:
             actions = [actions_list.get(id) for id in response_data['actions']]
-            params_with_list_names = replace_value_with_name(response_data['variables'], dict_names)
+            params_with_list_names = variables_with_list_names(response_data, dict_names, f"политики {item['name']}")
             rules_for_policy.append({
                 'rule_name': response_data['name'],
                 'rule_link': url_ui,
@@ -215,8 +1897,8 @@ async def get_rules_for_policy(item,headers):
     
     # Если у шаблона есть правила, возвращаем их
     if rules_for_policy:
-        url_ui_template = f"https://{creds['BACKUP_HOST']}/conf-scheme/user_policy/{item['template_id']}"
-        template_based_name = await get_template_name(item['template_id'], headers, "user")
+        url_ui_template = f"https://{client.host}/conf-scheme/user_policy/{item['template_id']}"
+        template_based_name = await get_template_name(item['template_id'], client, "user")
         return {
             "policy_name": item['name'], # Имя шаблона
             "based_on_name": template_based_name,
@@ -224,373 +1906,1571 @@ async def get_rules_for_policy(item,headers):
             "rules": rules_for_policy     # Список правил для этого шаблона
         }
 
-async def get_rules_policy(policies, headers):
-    """Основная функция для сбора правил для всех шаблонов."""
-    json_data = policies
-    
-    # Запускаем задачи для каждого шаблона параллельно
-    tasks = [get_rules_for_policy(item, headers) for item in json_data]
-    grouped_rules = await asyncio.gather(*tasks)
-
-    # Создаем директорию, если она не существует
-    os.makedirs("backup", exist_ok=True)
-
-    # Записываем данные в файл
-    with open("backup/policy_rules.json", 'w', encoding='utf-8') as file:
-        json.dump(grouped_rules, file, indent=4, ensure_ascii=False)
+async def get_rules_policy(client, snapshot, manifest=None, journal=None, selection=None):
+    """Основная функция для сбора правил для всех политик, устроена как get_rules_template."""
+    url = f'{client.api}/config/policies'
+    response_data = await fetch_data(client, url)
+    items = [item for item in response_data['items'] if selection is None or selection.selected('policies', item)]
+
+    async def process(item):
+        unit = f"policy:{item['id']}"
+        if journal is not None and journal.done(unit):
+            return journal.get(unit)
+        item = await get_user_policy(url, item, client, manifest, selection)
+        rules_entry = await get_rules_for_policy(item, client, manifest)
+        if journal is not None:
+            journal.record(unit, rules_entry)
+        return rules_entry
+
+    with snapshot.records('policy_rules') as records:
+        def write(rules_entry):
+            # Политики без изменённых правил в policy_rules.json не пишем
+            if rules_entry is not None:
+                records.append(rules_entry)
+                if selection is not None:
+                    selection.require_rules(rules_entry['rules'])
+
+        await run_ordered(items, process, write)
 
     print("Сбор правил для политик завершён.")
 
 
 '''Получение глобальных списков'''
-async def get_ip_from_list(headers, id, name):
-    url = f"{url_backup_api}/config/global_lists/{id}/file"
-    await fetch_and_save_file(url, headers, name)
-
-async def get_global_lists(headers):
-    url = f"{url_backup_api}/config/global_lists"
-    os.makedirs("backup/global_lists", exist_ok=True)
+async def get_ip_from_list(client, id, name, snapshot, manifest=None, journal=None):
+    url = f"{client.api}/config/global_lists/{id}/file"
+    unit = f"list_file:{name}"
+    # Файл уже лежит в снимке с прошлой попытки (в архив он не переносится, там качаем заново)
+    if journal is not None and journal.done(unit) and snapshot.has_list_file(name):
+        return
+    await fetch_and_save_file(client, url, snapshot, name, manifest)
+    if journal is not None:
+        journal.record(unit)
+
+async def get_global_lists(client, snapshot, manifest=None, journal=None, selection=None):
+    url = f"{client.api}/config/global_lists"
     lists = []
-    response_data = await fetch_data(url, headers=headers)
+    response_data = await fetch_reference(client, url)
     #print(response_data)
-    for item in response_data['items']:
-        if item['type'] == 'STATIC':
-           await get_ip_from_list(headers, item['id'], f"backup/global_lists/{item['name']}") 
+    items = [item for item in response_data['items'] if selection is None or selection.selected('lists', item)]
+    # Статические списки скачиваем параллельно, общий лимит задаёт client.limiter
+    await asyncio.gather(*(
+        get_ip_from_list(client, item['id'], item['name'], snapshot, manifest, journal)
+        for item in items if item['type'] == 'STATIC'
+    ))
+    for item in items:
         lists.append({
             'list_name': item['name'],
             'list_type': item['type']
         }
         )
-    # Записываем данные в файл
-    with open("backup/global_lists/global_lists.json", 'w', encoding='utf-8') as file:
-        json.dump(lists, file, indent=4, ensure_ascii=False)
+    # Записываем данные в снимок
+    with snapshot.records('global_lists') as records:
+        records.extend(lists)
 
     print("Сбор глобальных списков завершён.")    
 
-async def get_global_lists_names(headers):
-    url = f"{url_backup_api}/config/global_lists"
-    response_data = await fetch_data(url, headers)
+async def get_global_lists_names(client):
+    url = f"{client.api}/config/global_lists"
+    response_data = await fetch_reference(client, url)
     id_to_name = {item['id']: item['name'] for item in response_data['items']}
     return id_to_name
 
-def replace_value_with_name(data, id_to_name):
-    # Создаем копию данных, чтобы не изменять исходный JSON
-    data = data.copy() if isinstance(data, dict) else data[:] if isinstance(data, list) else data
-
-    if isinstance(data, dict):
-        # Если в словаре есть ключ 'global_param_type', заменяем 'value' на имя из словаря
-        if 'global_param_type' in data:
-            value = data.get('value')
-            if isinstance(value, list):
-                # Если value — это список, обрабатываем каждый элемент
-                data['value'] = [id_to_name.get(item, item) for item in value]
-            elif isinstance(value, str):
-                # Если value — это строка, заменяем её, если она есть в словаре
-                data['value'] = id_to_name.get(value, value)
-            return data  # Возвращаем измененный JSON
-        
-        # Рекурсивно обходим все значения в словаре
-        for key, value in data.items():
-            data[key] = replace_value_with_name(value, id_to_name)
-        return data  # Возвращаем JSON после рекурсивной обработки
-    
-    elif isinstance(data, list):
-        # Рекурсивно обходим все элементы списка
-        for i, item in enumerate(data):
-            data[i] = replace_value_with_name(item, id_to_name)
-        return data  # Возвращаем JSON после рекурсивной обработки
-    
-    else:
-        # Если данные не являются словарем или списком, возвращаем их без изменений
-        return data
+'''Перевод переменных правил'''
+class VariableTranslator:
+    """Подставляет в переменные правил имена глобальных списков вместо id и обратно.
+
+    Ссылка на список - словарь с ключом global_param_type, id (или имя) лежит в его value.
+    Форма переменных правила (ключи словарей на всех уровнях, где ссылки, где скаляры, какие
+    элементы у списков) запоминается один раз на имя правила и имена его переменных. Дальше
+    переменные обходятся по этой форме: у словарей сверяется набор ключей, у скаляров - что они
+    не стали словарём или списком, ссылки переводятся без поиска. Узел, который не совпал с формой
+    (новые ключи, ссылка на месте скаляра, список с разными элементами), обходится целиком через
+    apply_anywhere, так что ссылка в новом месте не пропускается.
+    Копируются только словари и списки на пути к изменённым значениям; если менять нечего,
+    возвращаются сами переменные.
+    """
+    SCALAR = object()     # Форма "не словарь и не список"
+    REFERENCE = object()  # Форма "ссылка на список"
+    UNKNOWN = object()    # Форма не известна: пустой список или элементы разной формы
+    CONTAINER_TYPES = frozenset((dict, list))
+
+    def __init__(self):
+        self.shapes = {}  # (имя правила, имена переменных) -> форма переменных
+
+    def translate(self, rule_name, variables, mapping):
+        """Возвращает (переменные с заменёнными значениями, [значения, которых нет в mapping])."""
+        unresolved = []
+        if rule_name is None or not isinstance(variables, dict):
+            return self.apply_anywhere(variables, mapping, unresolved), unresolved
+        key = (rule_name, tuple(variables))
+        shape = self.shapes.get(key)
+        if shape is None:
+            shape = self.shapes[key] = self.find_shape(variables)
+        return self.apply(variables, shape, mapping, unresolved), unresolved
+
+    def references(self, rule_name, variables):
+        """Значения всех ссылок на списки в переменных: имена в бекапе, id в API."""
+        return self.translate(rule_name, variables, {})[1]
+
+    @classmethod
+    def find_shape(cls, node):
+        """Форма узла: SCALAR, REFERENCE, UNKNOWN, (dict, ключи, ключи скаляров, ((ключ, форма), ...))
+        или (list, форма элементов)."""
+        if type(node) is dict:
+            if 'global_param_type' in node:
+                return cls.REFERENCE
+            scalar_keys = []
+            children = []
+            for key, child in node.items():
+                child_shape = cls.find_shape(child)
+                if child_shape is cls.SCALAR:
+                    scalar_keys.append(key)
+                else:
+                    children.append((key, child_shape))
+            return dict, frozenset(node), tuple(scalar_keys), tuple(children)
+        if type(node) is list:
+            if not node:
+                return cls.UNKNOWN
+            item_shape = cls.find_shape(node[0])
+            for child in node[1:]:
+                if cls.find_shape(child) != item_shape:
+                    return list, cls.UNKNOWN
+            return list, item_shape
+        if isinstance(node, (dict, list)):
+            return cls.UNKNOWN
+        return cls.SCALAR
+
+    @classmethod
+    def apply(cls, node, shape, mapping, unresolved):
+        """node с заменёнными ссылками по форме; тот же объект, если ничего не поменялось."""
+        kind = shape[0] if type(shape) is tuple else shape
+        if kind is dict:
+            if type(node) is not dict or node.keys() != shape[1]:
+                return cls.apply_anywhere(node, mapping, unresolved)
+            for key in shape[2]:
+                if type(node[key]) in cls.CONTAINER_TYPES:
+                    return cls.apply_anywhere(node, mapping, unresolved)
+            copy = None
+            for key, child_shape in shape[3]:
+                child = node[key]
+                new_child = cls.apply(child, child_shape, mapping, unresolved)
+                if new_child is not child:
+                    if copy is None:
+                        copy = node.copy()
+                    copy[key] = new_child
+            return node if copy is None else copy
+        if kind is cls.SCALAR:
+            if type(node) in cls.CONTAINER_TYPES:
+                return cls.apply_anywhere(node, mapping, unresolved)
+            return node
+        if kind is cls.REFERENCE and type(node) is dict and 'global_param_type' in node:
+            return cls.apply_reference(node, mapping, unresolved)
+        if kind is not list or type(node) is not list:
+            return cls.apply_anywhere(node, mapping, unresolved)
+        item_shape = shape[1]
+        if item_shape is cls.SCALAR:
+            for child in node:
+                if type(child) in cls.CONTAINER_TYPES:
+                    return cls.apply_anywhere(node, mapping, unresolved)
+            return node
+        copy = None
+        for index, child in enumerate(node):
+            new_child = cls.apply(child, item_shape, mapping, unresolved)
+            if new_child is not child:
+                if copy is None:
+                    copy = node.copy()
+                copy[index] = new_child
+        return node if copy is None else copy
+
+    @classmethod
+    def apply_anywhere(cls, node, mapping, unresolved):
+        """То же без дерева путей: обход всего поддерева, но тоже без лишних копий."""
+        if isinstance(node, dict):
+            if 'global_param_type' in node:
+                return cls.apply_reference(node, mapping, unresolved)
+            items = node.items()
+        elif isinstance(node, list):
+            items = enumerate(node)
+        else:
+            return node
+        copy = None
+        for key, child in items:
+            new_child = cls.apply_anywhere(child, mapping, unresolved)
+            if new_child is not child:
+                if copy is None:
+                    copy = node.copy()
+                copy[key] = new_child
+        return node if copy is None else copy
+
+    @staticmethod
+    def apply_reference(node, mapping, unresolved):
+        """Ссылка с заменённым value. Пустая строка - не ссылка, её не ищем."""
+        value = node.get('value')
+        if isinstance(value, list):
+            mapped = value
+            for index, item in enumerate(value):
+                if isinstance(item, str) and item:
+                    new_item = mapping.get(item)
+                    if new_item is None:
+                        unresolved.append(item)
+                    elif new_item != item:
+                        if mapped is value:
+                            mapped = value.copy()
+                        mapped[index] = new_item
+        elif isinstance(value, str) and value:
+            mapped = mapping.get(value)
+            if mapped is None:
+                unresolved.append(value)
+                mapped = value
+        else:
+            mapped = value
+        return node if mapped is value else {**node, 'value': mapped}
+
+# Форма переменных не зависит от тенанта, поэтому кэш общий на процесс
+variable_translator = VariableTranslator()
+
+def variables_with_list_names(rule, id_to_name, owner_label):
+    """Переменные правила из API с именами глобальных списков вместо id."""
+    variables, unresolved = variable_translator.translate(rule['name'], rule['variables'], id_to_name)
+    if unresolved:
+        print(f"Правило {rule['name']} {owner_label}: нет глобальных списков с id "
+              f"{', '.join(dict.fromkeys(unresolved))}, в бекапе остались id")
+    return variables
 
 
 '''Получение действий'''
-async def get_user_actions(headers):
-    url = f"{url_backup_api}/config/actions"
-    os.makedirs("backup", exist_ok=True)
+async def get_user_actions(client, snapshot, selection=None):
+    url = f"{client.api}/config/actions"
     user_action = []
-    dict_action_type_name = await get_action_type_name(headers)
-    response_data = await fetch_data(url, headers)
+    dict_action_type_name = await get_action_type_name(client)
+    response_data = await fetch_reference(client, url)
     for item in response_data['items']:
-        if not item['is_system']:
+        if not item['is_system'] and (selection is None or selection.selected('actions', item)):
             actions_type_name = dict_action_type_name.get(item['type_id'])
             user_action.append({
                 'action_name': item['name'],
                 'action_type': actions_type_name,
                 'action_params': item['params']
             })
-    with open("backup/user_actions.json", 'w', encoding='utf-8') as file:
-        json.dump(user_action, file, indent=4, ensure_ascii=False)
+    with snapshot.records('user_actions') as records:
+        records.extend(user_action)
     print("Сбор пользовательских действий завершен")
 
-async def get_action_type_name(headers, url_api=url_backup_api):
-    url = f"{url_api}/config/action_types"
-    response_data = await fetch_data(url, headers)
+async def get_action_type_name(client):
+    url = f"{client.api}/config/action_types"
+    response_data = await fetch_reference(client, url)
     id_to_name = {item['id']: item['name'] for item in response_data['items']}
     return id_to_name
 
-async def get_actions_name(headers, url_api=url_backup_api):
-    url = f"{url_api}/config/actions"
-    response_data = await fetch_data(url, headers)
+async def get_actions_name(client):
+    url = f"{client.api}/config/actions"
+    response_data = await fetch_reference(client, url)
     id_to_name = {item['id']: item['name'] for item in response_data['items']}
     return id_to_name
 
 
+'''План восстановления'''
+class RestorePlan:
+    """План восстановления: что создать и пропатчить в целевом тенанте, а что там уже совпадает с бекапом.
+
+    Каждый этап сначала сверяет бекап с тенантом и печатает свою часть плана, затем отправляет
+    только нужные запросы. В режиме dry_run план только печатается, тенант не меняется.
+    quiet - не печатать план и итоги этапов по частям, только общий итог (при синхронизации этапы
+    идут по одному объекту).
+    """
+    def __init__(self, dry_run=False, quiet=False):
+        self.dry_run = dry_run
+        self.quiet = quiet and not dry_run
+        self.totals = collections.Counter()
+        self.pending = collections.defaultdict(set)  # Вид объекта -> имена, которые будут созданы
+
+    def report(self, kind, create=(), patch=(), unchanged=0):
+        self.totals['create'] += len(create)
+        self.totals['patch'] += len(patch)
+        self.totals['unchanged'] += unchanged
+        self.pending[kind].update(create)
+        if self.quiet:
+            return
+        print(f"План ({kind}): создать {len(create)}, изменить {len(patch)}, без изменений {unchanged}")
+        if self.dry_run:
+            for name in create:
+                print(f"  + {name}")
+            for name in patch:
+                print(f"  ~ {name}")
+
+    def will_create(self, kind, name):
+        """Объекта нет в тенанте, но его создаст предыдущий этап (имеет значение только в dry_run)."""
+        return self.dry_run and name in self.pending[kind]
+
+    def summary(self):
+        verb = 'будет' if self.dry_run else 'было'
+        print(f"Итого {verb} создано {self.totals['create']}, изменено {self.totals['patch']}, "
+              f"уже совпадало {self.totals['unchanged']}")
+
+def name_exists(index, name):
+    return name in index.name_to_id or name in index.duplicates
+
+def rule_state(rule):
+    """Состояние правила из бекапа в том виде, в каком оно сравнивается с тенантом."""
+    return {'actions': rule['actions'], 'variables': rule['variables'], 'enabled': rule['is_active']}
+
+def current_rule_state(current, actions_index, lists_index):
+    """Состояние правила в тенанте с именами действий и списков вместо id, как в бекапе."""
+    return {
+        'actions': [actions_index.name_of(id) or id for id in current['actions']],
+        'variables': variable_translator.translate(current.get('name'), current['variables'], lists_index.id_to_name)[0],
+        'enabled': current['enabled']
+    }
+
+async def diff_rules(client, rules_url, rules, rules_index, actions_index, lists_index, owner_label):
+    """Сверяет правила из бекапа с тенантом. Возвращает ([(правило, id правила), ...] к патчу, число совпавших).
+
+    Текущее состояние правил запрашивается параллельно; правило, которое не удалось запросить, идёт к патчу.
+    rules_url=None - владельца правил ещё нет в тенанте (dry_run), тогда к патчу идут все правила.
+    """
+    resolved = []
+    for rule in rules:
+        try:
+            resolved.append((rule, rules_index.id_of(rule['rule_name'])))
+        except ReferenceLookupError as e:
+            print(f"Правило {rule['rule_name']} {owner_label} пропущено: {e}")
+    if rules_url is None:
+        return resolved, 0
+
+    async def fetch_current(rule, rule_id):
+        try:
+            return await fetch_data(client, f"{rules_url}/{rule_id}")
+        except ApiError as e:
+            # Сверить не удалось - правило патчим: PATCH выставит состояние из бекапа или сам сообщит об ошибке
+            print(f"Правило {rule['rule_name']} {owner_label} не сверено с тенантом, будет пропатчено: {e}")
+            return None
+
+    currents = await asyncio.gather(*(fetch_current(rule, rule_id) for rule, rule_id in resolved))
+    changed = [
+        (rule, rule_id) for (rule, rule_id), current in zip(resolved, currents)
+        if current is None or current_rule_state(current, actions_index, lists_index) != rule_state(rule)
+    ]
+    return changed, len(resolved) - len(changed)
+
+def rule_patch_data(rule, actions_index, lists_index):
+    """Тело PATCH правила. Действие или список, которого нет в тенанте, поднимает ReferenceLookupError:
+    id, не найденный по имени, в тенант не уходит."""
+    variables, unresolved = variable_translator.translate(rule['rule_name'], rule['variables'], lists_index.name_to_id)
+    for name in unresolved:
+        lists_index.id_of(name)  # Поднимет ошибку с причиной: списка нет или имя неоднозначно
+    return {
+        "actions": [actions_index.id_of(action) for action in rule['actions']],
+        "variables": variables,
+        "enabled": rule['is_active']
+    }
+
+
 '''Восстановление действий '''
-async def restore_user_actions(headers):
-    url = f"{url_restore_api}/config/actions"
-    user_actions = read_json('backup/user_actions.json')
-    dict_types_name = await get_action_type_name(headers, url_restore_api)
-    for i in user_actions:
-        id_action_type = find_key_by_value(dict_types_name, i['action_type'])
+async def restore_user_actions(client, snapshot, journal, plan):
+    url = f"{client.api}/config/actions"
+    user_actions = snapshot.read('user_actions')
+    types_index = await get_name_index(client, f"{client.api}/config/action_types", 'Тип действия')
+    actions_index = await get_name_index(client, url, 'Действие')
+
+    # Действия, которые уже есть в тенанте (по имени), не создаём повторно
+    to_create = [i for i in user_actions
+                 if not journal.done(f"action:{i['action_name']}") and not name_exists(actions_index, i['action_name'])]
+    plan.report('действия', create=[i['action_name'] for i in to_create],
+                unchanged=len(user_actions) - len(to_create))
+    if plan.dry_run:
+        return
+
+    async def restore_action(i):
+        unit = f"action:{i['action_name']}"
+        try:
+            id_action_type = types_index.id_of(i['action_type'])
+        except ReferenceLookupError as e:
+            print(f"Действие {i['action_name']} пропущено: {e}")
+            return
         data = {
             "type_id": id_action_type,
             "name": i['action_name'],
             "params": i['action_params']
         }
-        await post_with_headers_data(url, headers, data)
-    print('Пользовательские действия импортированы')
+        try:
+            await post_with_headers_data(client, url, data)
+        except ApiError as e:
+            print(f"Действие {i['action_name']} не создано: {e}")
+            return
+        journal.record(unit)
+
+    # Действия независимы друг от друга, создаём их параллельно
+    await asyncio.gather(*(restore_action(i) for i in to_create))
+    # Справочник действий изменился, следующие шаги должны увидеть новые id
+    if to_create:
+        client.refs.invalidate(url)
+    if not plan.quiet:
+        print('Пользовательские действия импортированы')
+
 
- 
 '''Восстановление списков'''
-async def restore_global_lists(headers):
-    url = f"{url_restore_api}/config/global_lists"
-    global_lists = read_json('backup/global_lists/global_lists.json')
-    
-    for i in global_lists:      
-        if i['list_type'] == "STATIC":
-            file = open(f"backup/global_lists/{i['list_name']}", "rb")
-            data = aiohttp.FormData()
-            data.add_field("name", i['list_name'])
-            data.add_field("type", i['list_type'])
-            data.add_field(
-                "file",  
-                file,  
-                filename=i['list_name'],  
-                content_type="text/plain" 
-            )                
-            
-            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
-                try:                    
-                    # Отправка запроса
-                    async with session.post(url, headers=headers, data=data) as response:
-                        if response.status == 201:
-                            print(f"{i['list_name']} загружен.")
-                        else:
-                            if response.status == 422:
-                                print(f"Статус: {response.status} {i['list_name']} не загружен, не уникальный")
-                            #print(await response.text())  # Вывод ошибки сервера
-                finally:
-                    file.close()
-        else:
-            boundary = f"----WebKitFormBoundary{uuid.uuid4().hex}"
-            token = headers.get('Authorization')
-            head = {
-                "Authorization": f"{token}",
-                "Content-Type": f"multipart/form-data; boundary={boundary}"
-            }
-
-            body = (
-                f"--{boundary}\r\n"
-                'Content-Disposition: form-data; name="name"\r\n\r\n'
-                f"{i['list_name']}\r\n"
-                f"--{boundary}\r\n"
-                'Content-Disposition: form-data; name="type"\r\n\r\n'
-                f"{i['list_type']}\r\n"
-                f"--{boundary}--\r\n"
-            )
-            
-            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:                                
-                # Отправка запроса
-                async with session.post(url, headers=head, data=body) as response:
-                    if response.status == 201:
-                        print(f"{i['list_name']} загружен.")
-                    else:
-                        if response.status == 422:
-                            print(f"Статус: {response.status} {i['list_name']} не загружен, не уникальный")
-                        #print(await response.text())  # Вывод ошибки сервера
-    await post_with_headers_data(f"{url_restore_api}/config/global_lists/apply", headers, payload='')
-    print('Пользовательские списки импортированы')
+def build_list_form(list_name, list_type, file=None):
+    """multipart/form-data для создания списка. Файл не читается в память, а стримится с диска кусками."""
+    writer = aiohttp.MultipartWriter('form-data')
+    for field, value in (('name', list_name), ('type', list_type)):
+        part = writer.append(value)
+        part.set_content_disposition('form-data', name=field)
+    if file is not None:
+        # Размер файла известен заранее, поэтому запрос уходит с Content-Length, а не chunked
+        part = writer.append(file, {'Content-Type': 'text/plain'})
+        part.set_content_disposition('form-data', name='file', filename=list_name)
+    return writer
+
+async def upload_global_list(client, url, item, snapshot, journal):
+    """Создаёт один список в тенанте. Возвращает (имя списка, HTTP-статус)."""
+    unit = f"list:{item['list_name']}"
+    if journal.done(unit):
+        return item['list_name'], journal.get(unit)
+
+    async def send(file=None):
+        form = build_list_form(item['list_name'], item['list_type'], file)
+        async with client.session.post(url, headers=client.headers, data=form) as response:
+            await check_response(response, ok=(201, 422))
+            return response.status
+
+    path = None
+    if item['list_type'] == "STATIC":
+        try:
+            path = snapshot.list_file_path(item['list_name'])
+        except MissingListFileError as e:
+            print(f"{item['list_name']} не загружен: {e}")
+            return item['list_name'], None
+
+    async def attempt():
+        if path is not None:
+            # Файл открываем только под лимитером: одновременно открыто не больше файлов, чем запросов.
+            # Каждая попытка открывает его заново, поэтому повтор шлёт файл с начала
+            with open(path, "rb") as file:
+                return await send(file)
+        return await send()
+
+    try:
+        status = await with_retries(client, 'POST', url, attempt)
+    except ApiError as e:
+        status = e.status
+    if status == 201:
+        print(f"{item['list_name']} загружен.")
+    elif status == 422:
+        print(f"Статус: {status} {item['list_name']} не загружен, не уникальный")
+    else:
+        print(f"Статус: {status} {item['list_name']} не загружен")
+    if status in (201, 422):
+        journal.record(unit, status)
+    return item['list_name'], status
+
+# Единица журнала: загруженные списки применены
+LISTS_APPLY_UNIT = 'lists:apply'
+
+async def restore_global_lists(client, snapshot, journal, plan):
+    url = f"{client.api}/config/global_lists"
+    global_lists = snapshot.read('global_lists')
+    lists_index = await get_dict_list_id_name(client)
+
+    # Списки, которые уже есть в тенанте, не загружаем; загруженные в прерванном прогоне берутся из журнала
+    to_upload = [i for i in global_lists if not name_exists(lists_index, i['list_name'])]
+    new_names = {i['list_name'] for i in to_upload if not journal.done(f"list:{i['list_name']}")}
+    plan.report('списки', create=[i['list_name'] for i in to_upload if i['list_name'] in new_names],
+                unchanged=len(global_lists) - len(to_upload))
+    if plan.dry_run:
+        return []
+
+    # Списки загружаем параллельно через общий пул соединений
+    results = await asyncio.gather(*(upload_global_list(client, url, i, snapshot, journal) for i in to_upload))
+    created = sum(1 for _, status in results if status == 201)
+    existed = sum(1 for _, status in results if status == 422)
+    # Загруженные списки начинают действовать после apply. Он нужен, если списки загружены в этом прогоне
+    # или в прерванном, который упал до apply: такие списки уже есть в тенанте и в to_upload не попали
+    uploaded_now = any(status == 201 and name in new_names for name, status in results)
+    uploaded_before = any(journal.get(f"list:{i['list_name']}") == 201 for i in global_lists)
+    if uploaded_now or (uploaded_before and not journal.done(LISTS_APPLY_UNIT)):
+        await post_with_headers_data(client, f"{client.api}/config/global_lists/apply", payload='')
+        journal.record(LISTS_APPLY_UNIT)
+        client.refs.invalidate(url)
+    print(f'Пользовательские списки импортированы: загружено {created}, уже были {existed + len(global_lists) - len(to_upload)}, '
+          f'ошибок {len(results) - created - existed}')
+    return results
 
 
 '''Восстановление шаблонов'''
-async def get_template_id_name(headers, owner):
-    url = f"{url_restore_api}/config/policies/templates/{owner}"
-    response_data = await fetch_data(url, headers=headers)
-    dict_id_name = {item['id']: item['name'] for item in response_data['items']}
-    return dict_id_name
-
-async def restore_templates(headers):
-    url = f"{url_restore_api}/config/policies/templates/user"
-    templates = read_json('backup/templates.json')
-    dict_id_name = await get_template_id_name(headers, 'vendor')
-    for i in templates:
+async def get_template_id_name(client, owner):
+    url = f"{client.api}/config/policies/templates/{owner}"
+    return await get_name_index(client, url, 'Шаблон')
+
+async def restore_templates(client, snapshot, journal, plan):
+    url = f"{client.api}/config/policies/templates/user"
+    templates = snapshot.read('templates')
+    templates_index = await get_template_id_name(client, 'vendor')
+    user_index = await get_template_id_name(client, 'user')
+
+    to_create = [i for i in templates if not journal.done(f"template:{i['name']}") and not name_exists(user_index, i['name'])]
+    plan.report('шаблоны', create=[i['name'] for i in to_create], unchanged=len(templates) - len(to_create))
+    if plan.dry_run:
+        return
+
+    async def restore_template(i):
+        unit = f"template:{i['name']}"
+        try:
+            based_on_id = templates_index.id_of(i['based_on_name'])
+        except ReferenceLookupError as e:
+            print(f"Шаблон {i['name']} пропущен: {e}")
+            return
         data = {
             'name': i['name'],
-            'templates': [find_key_by_value(dict_id_name, i['based_on_name'])],
-            'has_user_rules': i['has_user_rules']  
+            'templates': [based_on_id],
+            'has_user_rules': i['has_user_rules']
         }
-        await post_with_headers_data(url, headers, data)
-    print("Пользовательские шаблоны импортированы")
+        try:
+            await post_with_headers_data(client, url, data)
+        except ApiError as e:
+            print(f"Шаблон {i['name']} не создан: {e}")
+            return
+        journal.record(unit)
 
+    await asyncio.gather(*(restore_template(i) for i in to_create))
+    if to_create:
+        client.refs.invalidate(url)
+    if not plan.quiet:
+        print("Пользовательские шаблоны импортированы")
 
-'''Восстановление правил для шаблонов'''
-async def get_dict_system_rules(headers):
-    dict_template_id_name = await get_template_id_name(headers, 'vendor')
-    id1 = list(dict_template_id_name.keys())[0]
-    url = f"{url_restore_api}/config/policies/templates/vendor/{id1}/rules"
-    response_data = await fetch_data(url, headers)
-    dict_rules_id_name = {item['id']: item['name'] for item in response_data['items']}
-    return dict_rules_id_name
-
-async def get_dict_list_id_name(headers, url_api):
-    url = f"{url_api}/config/global_lists"
-    response_data = await fetch_data(url, headers)
-    id_to_name = {item['id']: item['name'] for item in response_data['items']}
-    return id_to_name
 
-async def restore_templates_rules(headers):
-    templates_rules = read_json('backup/template_rules.json')
-    templates_dict_id_name = await get_template_id_name(headers, 'user')
-    rules_dict_id_name = await get_dict_system_rules(headers)
-    actions_dict_id_name = await get_actions_name(headers, url_restore_api)
-    list_dict_id_name = await get_dict_list_id_name(headers, url_restore_api)
-    list_dict_name_id = {value: key for key, value in list_dict_id_name.items()}
-
-    for template in templates_rules:
-        template_id = find_key_by_value(templates_dict_id_name, template['template_name'])
-        for rule in template['rules']:
-            rule_id = find_key_by_value(rules_dict_id_name, rule['rule_name'])
-            actions = []
-            for action in rule['actions']:
-                actions.append(find_key_by_value(actions_dict_id_name, action))
-            params_with_list_ids = replace_value_with_name(rule['variables'], list_dict_name_id)            
-            data = {
-                "actions": actions,
-                "variables": params_with_list_ids,
-                "enabled": rule['is_active']
-            }
-            url = f"{url_restore_api}/config/policies/templates/user/{template_id}/rules/{rule_id}"
-            await patch_data(url, headers, data)
+'''Восстановление правил для шаблонов'''
+async def get_dict_system_rules(client):
+    templates_index = await get_template_id_name(client, 'vendor')
+    id1 = next(iter(templates_index.id_to_name))
+    url = f"{client.api}/config/policies/templates/vendor/{id1}/rules"
+    return await get_name_index(client, url, 'Системное правило', paged=True)
+
+async def get_dict_list_id_name(client):
+    url = f"{client.api}/config/global_lists"
+    return await get_name_index(client, url, 'Глобальный список')
+
+async def restore_templates_rules(client, snapshot, journal, plan):
+    templates_rules = snapshot.read('template_rules')
+    templates_index = await get_template_id_name(client, 'user')
+    rules_index = await get_dict_system_rules(client)
+    actions_index = await get_name_index(client, f"{client.api}/config/actions", 'Действие')
+    lists_index = await get_dict_list_id_name(client)
+
+    async def plan_template_rules(template):
+        """Правила шаблона, которые в тенанте отличаются от бекапа: (шаблон, id шаблона, [(правило, id правила)], совпало)."""
+        try:
+            template_id = templates_index.id_of(template['template_name'])
+            rules_url = f"{client.api}/config/policies/templates/user/{template_id}/rules"
+        except ReferenceLookupError as e:
+            if not plan.will_create('шаблоны', template['template_name']):
+                print(f"Правила шаблона {template['template_name']} пропущены: {e}")
+                return None
+            template_id = rules_url = None
+        rules = [rule for rule in template['rules']
+                 if not journal.done(f"template_rule:{template['template_name']}:{rule['rule_name']}")]
+        changed, unchanged = await diff_rules(client, rules_url, rules, rules_index, actions_index, lists_index,
+                                              f"шаблона {template['template_name']}")
+        return template, template_id, changed, unchanged + len(template['rules']) - len(rules)
+
+    async def restore_rule(template, template_id, rule, rule_id):
+        unit = f"template_rule:{template['template_name']}:{rule['rule_name']}"
+        try:
+            data = rule_patch_data(rule, actions_index, lists_index)
+        except ReferenceLookupError as e:
+            print(f"Правило {rule['rule_name']} шаблона {template['template_name']} пропущено: {e}")
+            return
+        url = f"{client.api}/config/policies/templates/user/{template_id}/rules/{rule_id}"
+        try:
+            await patch_data(client, url, data)
+        except ApiError as e:
+            print(f"Правило {rule['rule_name']} шаблона {template['template_name']} не восстановлено: {e}")
+            return
+        journal.record(unit)
+
+    async def restore_template_rules(template, template_id, changed):
+        await asyncio.gather(*(restore_rule(template, template_id, rule, rule_id) for rule, rule_id in changed))
         print(f'Правила для шаблона {template["template_name"]} восстановлены')
-    print('Правила во всех шаблонах восстановлены')
+
+    # Сначала сверяем все шаблоны с тенантом, затем патчим только отличающиеся правила
+    plans = await asyncio.gather(*(plan_template_rules(template) for template in templates_rules if template is not None))
+    plans = [p for p in plans if p is not None]
+    plan.report('правила шаблонов',
+                patch=[f"{template['template_name']}: {rule['rule_name']}" for template, _, changed, _ in plans for rule, _ in changed],
+                unchanged=sum(unchanged for *_, unchanged in plans))
+    if plan.dry_run:
+        return
+
+    # Шаблоны и правила внутри них патчим параллельно, общий лимит задаёт client.limiter
+    await asyncio.gather(*(restore_template_rules(template, template_id, changed)
+                           for template, template_id, changed, _ in plans if changed))
+    if not plan.quiet:
+        print('Правила во всех шаблонах восстановлены')
 
 
 '''Восстановление политики'''
-async def restore_policies(headers):
-    url = f"{url_restore_api}/config/applications"
-    policies = read_json('backup/policy_rules.json')
-    dict_id_name = await get_template_id_name(headers, 'user')
-    for i in policies:
-        if i is not None:
-            data = {
-                'name': i['policy_name'],
-                "protection_mode": "PASSIVE",
-                "hosts": [],
-                "locations": ["/"],
-                'policy_template_id': find_key_by_value(dict_id_name, i['based_on_name']),
-                "traffic_profiles": []
-            }
-            await post_with_headers_data(url, headers, data)
-            
-    print("Пользовательские приложения импортированы")
+async def restore_policies(client, snapshot, journal, plan):
+    url = f"{client.api}/config/applications"
+    policies = [i for i in snapshot.read('policy_rules') if i is not None]
+    templates_index = await get_template_id_name(client, 'user')
+    # Вместе с приложением создаётся одноимённая политика, по ней и проверяем, есть ли приложение
+    policies_index = await get_policies_id_name(client)
+
+    to_create = [i for i in policies
+                 if not journal.done(f"application:{i['policy_name']}") and not name_exists(policies_index, i['policy_name'])]
+    plan.report('приложения', create=[i['policy_name'] for i in to_create], unchanged=len(policies) - len(to_create))
+    if plan.dry_run:
+        return
+
+    async def restore_policy(i):
+        unit = f"application:{i['policy_name']}"
+        try:
+            template_id = templates_index.id_of(i['based_on_name'])
+        except ReferenceLookupError as e:
+            print(f"Приложение {i['policy_name']} пропущено: {e}")
+            return
+        data = {
+            'name': i['policy_name'],
+            "protection_mode": "PASSIVE",
+            "hosts": [],
+            "locations": ["/"],
+            'policy_template_id': template_id,
+            "traffic_profiles": []
+        }
+        try:
+            await post_with_headers_data(client, url, data)
+        except ApiError as e:
+            print(f"Приложение {i['policy_name']} не создано: {e}")
+            return
+        journal.record(unit)
+
+    await asyncio.gather(*(restore_policy(i) for i in to_create))
+    # Вместе с приложением создаётся его политика
+    if to_create:
+        client.refs.invalidate(f"{client.api}/config/policies")
+    if not plan.quiet:
+        print("Пользовательские приложения импортированы")
 
 
 '''Восстановление правил для политики'''
-async def get_policies_id_name(headers):
-    url = f"{url_restore_api}/config/policies"
-    response_data = await fetch_data(url, headers=headers)
-    dict_id_name = {item['id']: item['name'] for item in response_data['items']}
-    return dict_id_name
-
-async def restore_policies_rules(headers):
-    policies_rules = read_json('backup/policy_rules.json')
-    policies_dict_id_name = await get_policies_id_name(headers)
-    rules_dict_id_name = await get_dict_system_rules(headers)
-    actions_dict_id_name = await get_actions_name(headers, url_restore_api)
-    list_dict_id_name = await get_dict_list_id_name(headers, url_restore_api)
-    list_dict_name_id = {value: key for key, value in list_dict_id_name.items()}
-
-
-    for policy in policies_rules:
-        if policy is not None:
-            policy_id = find_key_by_value(policies_dict_id_name, policy['policy_name'])
-            for rule in policy['rules']:
-                rule_id = find_key_by_value(rules_dict_id_name, rule['rule_name'])
-                actions = []
-                for action in rule['actions']:
-                    actions.append(find_key_by_value(actions_dict_id_name, action))
-                params_with_list_ids = replace_value_with_name(rule['variables'], list_dict_name_id)            
-                data = {
-                    "actions": actions,
-                    "variables": params_with_list_ids,
-                    "enabled": rule['is_active']
-                }
-                url = f"{url_restore_api}/config/policies/{policy_id}/rules/{rule_id}"
-                await patch_data(url, headers, data)
-            print(f'Правила для политики {policy["policy_name"]} восстановлены')
-    print('Правила во всех политиках восстановлены')
+async def get_policies_id_name(client):
+    url = f"{client.api}/config/policies"
+    return await get_name_index(client, url, 'Политика')
+
+async def restore_policies_rules(client, snapshot, journal, plan):
+    policies_rules = snapshot.read('policy_rules')
+    policies_index = await get_policies_id_name(client)
+    rules_index = await get_dict_system_rules(client)
+    actions_index = await get_name_index(client, f"{client.api}/config/actions", 'Действие')
+    lists_index = await get_dict_list_id_name(client)
+
+    async def plan_policy_rules(policy):
+        """Правила политики, которые в тенанте отличаются от бекапа: (политика, id политики, [(правило, id правила)], совпало)."""
+        try:
+            policy_id = policies_index.id_of(policy['policy_name'])
+            rules_url = f"{client.api}/config/policies/{policy_id}/rules"
+        except ReferenceLookupError as e:
+            if not plan.will_create('приложения', policy['policy_name']):
+                print(f"Правила политики {policy['policy_name']} пропущены: {e}")
+                return None
+            policy_id = rules_url = None
+        rules = [rule for rule in policy['rules']
+                 if not journal.done(f"policy_rule:{policy['policy_name']}:{rule['rule_name']}")]
+        changed, unchanged = await diff_rules(client, rules_url, rules, rules_index, actions_index, lists_index,
+                                              f"политики {policy['policy_name']}")
+        return policy, policy_id, changed, unchanged + len(policy['rules']) - len(rules)
+
+    async def restore_rule(policy, policy_id, rule, rule_id):
+        unit = f"policy_rule:{policy['policy_name']}:{rule['rule_name']}"
+        try:
+            data = rule_patch_data(rule, actions_index, lists_index)
+        except ReferenceLookupError as e:
+            print(f"Правило {rule['rule_name']} политики {policy['policy_name']} пропущено: {e}")
+            return
+        url = f"{client.api}/config/policies/{policy_id}/rules/{rule_id}"
+        try:
+            await patch_data(client, url, data)
+        except ApiError as e:
+            print(f"Правило {rule['rule_name']} политики {policy['policy_name']} не восстановлено: {e}")
+            return
+        journal.record(unit)
+
+    async def restore_policy_rules(policy, policy_id, changed):
+        await asyncio.gather(*(restore_rule(policy, policy_id, rule, rule_id) for rule, rule_id in changed))
+        print(f'Правила для политики {policy["policy_name"]} восстановлены')
+
+    plans = await asyncio.gather(*(plan_policy_rules(policy) for policy in policies_rules if policy is not None))
+    plans = [p for p in plans if p is not None]
+    plan.report('правила политик',
+                patch=[f"{policy['policy_name']}: {rule['rule_name']}" for policy, _, changed, _ in plans for rule, _ in changed],
+                unchanged=sum(unchanged for *_, unchanged in plans))
+    if plan.dry_run:
+        return
+
+    await asyncio.gather(*(restore_policy_rules(policy, policy_id, changed)
+                           for policy, policy_id, changed, _ in plans if changed))
+    if not plan.quiet:
+        print('Правила во всех политиках восстановлены')
+
+
+'''Планировщик восстановления'''
+# Этап: (функция, этапы, которые должны завершиться до его запуска).
+# Действия и списки независимы, шаблоны нужны правилам шаблонов и приложениям,
+# приложения (и их политики) - правилам политик. Правилам нужны id действий и списков.
+RESTORE_STAGES = {
+    'actions': (restore_user_actions, []),
+    'global_lists': (restore_global_lists, []),
+    'templates': (restore_templates, []),
+    'templates_rules': (restore_templates_rules, ['templates', 'actions', 'global_lists']),
+    'applications': (restore_policies, ['templates']),
+    'policies_rules': (restore_policies_rules, ['applications', 'actions', 'global_lists']),
+}
+
+async def run_restore_stages(client, snapshot, journal, plan, report, stages=RESTORE_STAGES):
+    """Запускает этапы параллельно, каждый - как только завершены его зависимости."""
+    tasks = {}
+
+    async def run_stage(name):
+        func, depends_on = stages[name]
+        await asyncio.gather(*(tasks[dep] for dep in depends_on))
+        await report.timed(client, func(client, snapshot, journal, plan))
+
+    for name in stages:
+        tasks[name] = asyncio.ensure_future(run_stage(name))
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        # Если один этап упал, остальные не продолжают работу вслепую
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+
+'''Проверка восстановления'''
+# Сколько расхождений печатать в консоль, полный список - в JSON-отчёте
+VERIFY_PRINT_LIMIT = 20
+VERIFY_PROBLEMS = {
+    'missing': 'нет в тенанте',
+    'ambiguous': 'несколько объектов с таким именем',
+    'different': 'отличаются поля',
+    'error': 'не удалось запросить',
+}
+
+class VerifyReport:
+    """Расхождения целевого тенанта с бекапом после восстановления.
+
+    Расхождение - объект бекапа, которого в тенанте нет (missing), чьё имя там неоднозначно
+    (ambiguous), чьи поля отличаются (different) или который не удалось запросить (error).
+    """
+    def __init__(self):
+        self.checked = collections.Counter()
+        self.mismatches = []
+
+    def mismatch(self, kind, name, problem, owner=None, detail=None, fields=None):
+        self.checked[kind] += 1
+        item = {'kind': kind, 'owner': owner, 'name': name, 'problem': problem, 'detail': detail, 'fields': fields}
+        self.mismatches.append({key: value for key, value in item.items() if value is not None})
+
+    def lookup(self, kind, index, name, owner=None):
+        """id объекта по имени; если его нет или имя неоднозначно - расхождение и None."""
+        try:
+            return index.id_of(name)
+        except ReferenceLookupError as e:
+            problem = 'ambiguous' if name in index.duplicates else 'missing'
+            self.mismatch(kind, name, problem, owner, str(e))
+            return None
+
+    def failed(self, kind, name, error, owner=None):
+        self.mismatch(kind, name, 'error', owner, str(error))
+
+    def check(self, kind, name, expected, actual, owner=None):
+        """Сравнивает поля объекта из бекапа (expected) с тенантом (actual)."""
+        fields = {key: {'expected': value, 'actual': actual.get(key)}
+                  for key, value in expected.items() if actual.get(key) != value}
+        if fields:
+            self.mismatch(kind, name, 'different', owner, fields=fields)
+        else:
+            self.checked[kind] += 1
+
+    def report(self):
+        return {
+            'ok': not self.mismatches,
+            'checked': dict(self.checked),
+            'mismatches': sorted(self.mismatches, key=lambda item: (item['kind'], item.get('owner') or '', item['name']))
+        }
+
+    def write_json(self, file_path):
+        write_json(file_path, self.report())
+
+    def print_summary(self, limit=VERIFY_PRINT_LIMIT):
+        report = self.report()
+        print(f"Проверка восстановления: проверено {sum(self.checked.values())} объектов, "
+              f"расхождений {len(self.mismatches)}")
+        for item in report['mismatches'][:limit]:
+            where = f"{item['kind']} {item['owner']}" if 'owner' in item else item['kind']
+            if item['problem'] in ('missing', 'ambiguous'):
+                reason = item['detail']  # Причина от NameIndex уже говорит, чего не хватает
+            else:
+                reason = f"{VERIFY_PROBLEMS[item['problem']]}: {', '.join(item['fields']) if 'fields' in item else item['detail']}"
+            print(f"  {where}: {item['name']} - {reason}")
+        if len(self.mismatches) > limit:
+            print(f"  ... и ещё {len(self.mismatches) - limit}, полный список - в отчёте о проверке")
+
+def list_file_hash(path):
+    """sha256 файла списка из снимка: в том же виде, в каком stream_normalized_lines хэширует ответ API."""
+    file_hash = hashlib.sha256()
+    with open(path, 'r', encoding='utf-8') as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), ''):
+            file_hash.update(chunk.encode('utf-8'))
+    return file_hash.hexdigest()
+
+async def normalized_lines_hash(response):
+    """sha256 файла списка из ответа API, нормализованного как при бекапе; на диск ничего не пишется."""
+    with open(os.devnull, 'w', encoding='utf-8') as sink:
+        return await stream_normalized_lines(response, sink)
+
+async def verify_user_actions(client, snapshot, result):
+    response_data = await fetch_reference(client, f"{client.api}/config/actions")
+    types = await get_action_type_name(client)
+    actions = {item['id']: item for item in response_data['items']}
+    actions_index = NameIndex({id: item['name'] for id, item in actions.items()}, 'Действие')
+    for action in snapshot.read('user_actions'):
+        action_id = result.lookup('действия', actions_index, action['action_name'])
+        if action_id is not None:
+            current = actions[action_id]
+            result.check('действия', action['action_name'],
+                         {'action_type': action['action_type'], 'action_params': action['action_params']},
+                         {'action_type': types.get(current['type_id']), 'action_params': current['params']})
+
+async def verify_global_lists(client, snapshot, result):
+    url = f"{client.api}/config/global_lists"
+    response_data = await fetch_reference(client, url)
+    lists = {item['id']: item for item in response_data['items']}
+    lists_index = NameIndex({id: item['name'] for id, item in lists.items()}, 'Глобальный список')
+
+    async def verify_list(item):
+        list_id = result.lookup('списки', lists_index, item['list_name'])
+        if list_id is None:
+            return
+        expected = {'list_type': item['list_type']}
+        actual = {'list_type': lists[list_id]['type']}
+        # Содержимое сравниваем по хэшу: файл из тенанта не хранится ни в памяти, ни на диске
+        if item['list_type'] == 'STATIC' == actual['list_type']:
+            try:
+                expected['content_sha256'] = list_file_hash(snapshot.list_file_path(item['list_name']))
+                actual['content_sha256'] = await api_request(client, 'GET', f"{url}/{list_id}/file", ok=(200,),
+                                                              handle=normalized_lines_hash)
+            except (ApiError, MissingListFileError) as e:
+                result.failed('списки', item['list_name'], e)
+                return
+        result.check('списки', item['list_name'], expected, actual)
+
+    await asyncio.gather(*(verify_list(item) for item in snapshot.read('global_lists')))
+
+async def verify_templates(client, snapshot, result):
+    user_index = await get_template_id_name(client, 'user')
+    vendor_index = await get_template_id_name(client, 'vendor')
+
+    async def verify_template(template):
+        template_id = result.lookup('шаблоны', user_index, template['name'])
+        if template_id is None:
+            return
+        try:
+            current = await fetch_data(client, f"{client.api}/config/policies/templates/user/{template_id}")
+        except ApiError as e:
+            result.failed('шаблоны', template['name'], e)
+            return
+        result.check('шаблоны', template['name'],
+                     {'based_on_name': template['based_on_name'], 'has_user_rules': template['has_user_rules']},
+                     {'based_on_name': vendor_index.name_of(next(iter(current['templates']), None)),
+                      'has_user_rules': current['has_user_rules']})
+
+    await asyncio.gather(*(verify_template(template) for template in snapshot.read('templates')))
+
+async def verify_policies(client, snapshot, result):
+    policies_index = await get_policies_id_name(client)
+    templates_index = await get_template_id_name(client, 'user')
+
+    async def verify_policy(policy):
+        policy_id = result.lookup('приложения', policies_index, policy['policy_name'])
+        if policy_id is None:
+            return
+        try:
+            current = await fetch_data(client, f"{client.api}/config/policies/{policy_id}")
+        except ApiError as e:
+            result.failed('приложения', policy['policy_name'], e)
+            return
+        result.check('приложения', policy['policy_name'], {'based_on_name': policy['based_on_name']},
+                     {'based_on_name': templates_index.name_of(current['template_id'])})
+
+    await asyncio.gather(*(verify_policy(policy) for policy in snapshot.read('policy_rules') if policy is not None))
+
+async def verify_rules(client, result, kind, entries, owners_index, rules_url):
+    """Сверяет правила владельцев (шаблонов или политик) entries = [(имя владельца, правила)] с тенантом.
+    rules_url(id владельца) - URL правил владельца."""
+    rules_index = await get_dict_system_rules(client)
+    actions_index = await get_name_index(client, f"{client.api}/config/actions", 'Действие')
+    lists_index = await get_dict_list_id_name(client)
+
+    async def verify_rule(owner, url, rule):
+        rule_id = result.lookup(kind, rules_index, rule['rule_name'], owner)
+        if rule_id is None:
+            return
+        try:
+            current = await fetch_data(client, f"{url}/{rule_id}")
+        except ApiError as e:
+            result.failed(kind, rule['rule_name'], e, owner)
+            return
+        result.check(kind, rule['rule_name'], rule_state(rule),
+                     current_rule_state(current, actions_index, lists_index), owner)
+
+    checks = []
+    for owner, rules in entries:
+        try:
+            url = rules_url(owners_index.id_of(owner))
+        except ReferenceLookupError as e:
+            # Правил без владельца в тенанте тоже нет
+            for rule in rules:
+                result.mismatch(kind, rule['rule_name'], 'missing', owner, str(e))
+            continue
+        checks += [verify_rule(owner, url, rule) for rule in rules]
+    # Все правила всех владельцев запрашиваются параллельно, общий лимит задаёт client.limiter
+    await asyncio.gather(*checks)
+
+async def verify_templates_rules(client, snapshot, result):
+    entries = [(entry['template_name'], entry['rules']) for entry in snapshot.read('template_rules') if entry is not None]
+    await verify_rules(client, result, 'правила шаблонов', entries, await get_template_id_name(client, 'user'),
+                       lambda id: f"{client.api}/config/policies/templates/user/{id}/rules")
+
+async def verify_policies_rules(client, snapshot, result):
+    entries = [(entry['policy_name'], entry['rules']) for entry in snapshot.read('policy_rules') if entry is not None]
+    await verify_rules(client, result, 'правила политик', entries, await get_policies_id_name(client),
+                       lambda id: f"{client.api}/config/policies/{id}/rules")
+
+VERIFY_STAGES = (verify_user_actions, verify_global_lists, verify_templates, verify_policies,
+                 verify_templates_rules, verify_policies_rules)
+
+async def verify_restore(client, snapshot, report):
+    """Сверяет целевой тенант со снимком после восстановления, возвращает VerifyReport.
+
+    Всё перечитывается из тенанта заново (справочники, закэшированные восстановлением, сбрасываются)
+    и приводится к виду бекапа теми же функциями, что и сверка перед восстановлением.
+    Виды объектов проверяются параллельно, запросы идут через общий лимитер клиента.
+    """
+    client.refs = ReferenceCache()
+    result = VerifyReport()
+    await asyncio.gather(*(report.timed(client, stage(client, snapshot, result)) for stage in VERIFY_STAGES))
+    result.print_summary()
+    return result
+
+def save_verification(verification, verify_path):
+    if verification is not None and verify_path:
+        verification.write_json(verify_path)
+        print(f'Отчёт о проверке: {verify_path}')
+
+
+'''Выборочный бекап и восстановление'''
+# Вид объекта -> (суффикс ключей --include-.../--exclude-..., как он называется в подсказке)
+SELECTION_KINDS = {
+    'templates': ('template', 'пользовательские шаблоны'),
+    'policies': ('policy', 'политики (приложения)'),
+    'lists': ('list', 'глобальные списки'),
+    'actions': ('action', 'пользовательские действия'),
+}
+
+class ObjectSelection:
+    """Какие объекты тенанта обрабатывать: фильтры include/exclude по видам объектов и их зависимости.
+
+    Шаблон фильтра - имя, glob (fnmatch, с учётом регистра) или id объекта. Если include не задан
+    ни для одного вида, берётся весь тенант без исключённого. Иначе остальные виды берутся только
+    как зависимости выбранного: политика тянет свой шаблон, шаблон и политика - действия и списки,
+    упомянутые в их правилах. exclude сильнее всего, в том числе зависимостей.
+    """
+    def __init__(self, include=None, exclude=None):
+        self.include = {kind: list(patterns) for kind, patterns in (include or {}).items() if patterns}
+        self.exclude = {kind: list(patterns) for kind, patterns in (exclude or {}).items() if patterns}
+        self.required = collections.defaultdict(set)  # Вид -> имена и id, нужные выбранным объектам
+        # Вид -> {id: детали}: объекты, запрошенные при сборе зависимостей, повторно не запрашиваются
+        self.details = collections.defaultdict(dict)
+
+    @property
+    def partial(self):
+        """Выбрана часть тенанта: зависимости нужно собрать до того, как обрабатывать их виды."""
+        return bool(self.include)
+
+    @staticmethod
+    def matches(patterns, item):
+        values = [str(item[key]) for key in ('name', 'id') if item.get(key) is not None]
+        return any(fnmatch.fnmatchcase(value, pattern) for pattern in patterns for value in values)
+
+    def selected(self, kind, item):
+        """Обрабатывать ли объект item (словарь с name и, если известен, id) вида kind."""
+        if self.matches(self.exclude.get(kind, ()), item):
+            return False
+        if not self.include:
+            return True
+        required = self.required[kind]
+        return self.matches(self.include.get(kind, ()), item) or item.get('name') in required or item.get('id') in required
+
+    def fresh(self):
+        """Те же фильтры без собранных зависимостей: зависимости у каждого тенанта и прогона свои."""
+        return ObjectSelection(self.include, self.exclude)
+
+    def require(self, kind, values):
+        self.required[kind].update(values)
+
+    def remember_details(self, kind, item):
+        self.details[kind][item['id']] = item
+
+    def take_details(self, kind, id):
+        """Детали, уже запрошенные при сборе зависимостей, или None. Отдаются один раз."""
+        return self.details[kind].pop(id, None)
+
+    def require_rules(self, rules):
+        """Действия и списки, на которые ссылаются правила выбранного шаблона или политики."""
+        for rule in rules:
+            self.require('actions', rule['actions'])
+            self.require('lists', variable_translator.references(rule['rule_name'], rule['variables']))
+
+async def resolve_policy_templates(client, selection, manifest=None):
+    """Шаблоны, на которых основаны выбранные политики: их бекапим вместе с политиками.
+    Детали запрашиваются только у выбранных политик и остаются в selection для get_rules_policy."""
+    if 'policies' not in selection.include:
+        return
+    url = f'{client.api}/config/policies'
+    response_data = await fetch_data(client, url)
+    policies = [item for item in response_data['items'] if selection.selected('policies', item)]
+    details = await asyncio.gather(*(get_user_policy(url, item, client, manifest) for item in policies))
+    for item in details:
+        selection.remember_details('policies', item)
+    selection.require('templates', [item['template_id'] for item in details])
+
+async def run_backup_stages(client, snapshot, report, manifest=None, journal=None, selection=None):
+    """Бекап всех видов объектов. Без выборки (или только с exclude) виды идут параллельно;
+    при выборочном бекапе сначала шаблоны выбранных политик, потом шаблоны и политики,
+    и только потом действия и списки, на которые ссылаются их правила."""
+    selection = selection.fresh() if selection is not None else None
+    templates = lambda: report.timed(client, get_rules_template(client, snapshot, manifest, journal, selection))
+    policies = lambda: report.timed(client, get_rules_policy(client, snapshot, manifest, journal, selection))
+    lists = lambda: report.timed(client, get_global_lists(client, snapshot, manifest, journal, selection))
+    actions = lambda: report.timed(client, get_user_actions(client, snapshot, selection))
+    if selection is None or not selection.partial:
+        await asyncio.gather(templates(), policies(), lists(), actions())
+        return
+    await report.timed(client, resolve_policy_templates(client, selection, manifest))
+    await asyncio.gather(templates(), policies())
+    await asyncio.gather(lists(), actions())
+
+def select_records(snapshot, selection):
+    """Снимок только с выбранными объектами и их зависимостями, для восстановления.
+    В снимке id нет, поэтому фильтры сравниваются только с именами."""
+    selection = selection.fresh()
+    policies = [entry for entry in snapshot.read('policy_rules')
+                if entry is not None and selection.selected('policies', {'name': entry['policy_name']})]
+    selection.require('templates', [entry['based_on_name'] for entry in policies])
+    template_rules = [entry for entry in snapshot.read('template_rules')
+                      if entry is not None and selection.selected('templates', {'name': entry['template_name']})]
+    for entry in template_rules + policies:
+        selection.require_rules(entry['rules'])
+    records = {
+        'templates': [item for item in snapshot.read('templates') if selection.selected('templates', item)],
+        'template_rules': template_rules,
+        'policy_rules': policies,
+        'user_actions': [item for item in snapshot.read('user_actions')
+                         if selection.selected('actions', {'name': item['action_name']})],
+        'global_lists': [item for item in snapshot.read('global_lists')
+                         if selection.selected('lists', {'name': item['list_name']})],
+    }
+    print(f"Выбрано для восстановления: шаблонов {len(records['templates'])}, приложений {len(policies)}, "
+          f"действий {len(records['user_actions'])}, списков {len(records['global_lists'])}")
+    return RecordsSnapshot(records, snapshot)
 
 
 '''Главная функция бекапа'''
-async def backup():
+async def backup(tenant, incremental=False, snapshot_format='dir', compression='gzip', resume=False, budget=None,
+                 report=None, store_root=STORE_ROOT, selection=None):
+    """Бекап тенанта в tenant.root (в формате store - новый снимок в хранилище store_root).
+    report - RunReport, куда записать метрики прогона.
+    selection - ObjectSelection: бекапить только выбранные объекты и их зависимости."""
     start_time = time.time()
+    report = report if report is not None else RunReport('backup')
+    snapshot = open_snapshot(snapshot_format, compression, tenant.root, store_root, tenant.store_name)
+    manifest = BackupManifest.load(incremental, snapshot)
+    journal = CheckpointJournal(os.path.join(tenant.root, BACKUP_JOURNAL), resume)
+    if journal.resumed:
+        print(f"Продолжаем прерванный бекап: уже готово {journal.resumed} единиц")
     
-    headers = await get_headers(creds['BACKUP_HOST'], creds['BACKUP_USERNAME'], creds['BACKUP_PASSWORD'])
-
-    # Запускаем задачи параллельно
-    templates, policies = await asyncio.gather(
-        get_user_templates(url_backup_api, headers),
-        get_user_policy(url_backup_api, headers)
-    )
-
-    await asyncio.gather(
-        get_rules_template(templates, headers),
-        get_rules_policy(policies, headers),
-        get_global_lists(headers),
-        get_user_actions(headers)
-
-    )
+    # Один клиент (и один пул соединений) на весь бекап
+    try:
+        async with ApiClient(tenant.host, tenant.max_concurrency, budget=budget, page_size=tenant.page_size) as client:
+            report.add_client(tenant.name, client)
+            await get_headers(client, tenant.username, tenant.password)
+
+            await run_backup_stages(client, snapshot, report, manifest, journal, selection)
+            report_retries(client)
+    except BaseException:
+        # Журнал оставляем: с --resume бекап продолжится с места падения
+        journal.close()
+        raise
+
+    # Архив и манифест фиксируются только после успешного бекапа
+    snapshot.close()
+    manifest.save()
+    journal.finish()
+    if incremental:
+        print(f"Взято из прошлого снимка без изменений: {manifest.reused} объектов")
 
     end_time = time.time()
     execution_time = end_time - start_time
     print(f"Время выполнения: {execution_time:.2f} секунд")
-    print('Бекап готов! Смотрите директорию backup')
+    if snapshot.format == 'store':
+        print(f'Бекап готов! Снимок {snapshot.id} в хранилище {store_root}')
+    else:
+        print(f'Бекап готов! Смотрите директорию {tenant.root}')
 
 
 '''Главная функция восстановления'''
 
-async def restore():
+async def restore(tenant, snapshot_format='dir', resume=False, dry_run=False, budget=None, report=None,
+                  store_root=STORE_ROOT, snapshot_id=None, verify=False, verify_path=None, selection=None,
+                  snapshot_tenant=None):
+    """Восстановление тенанта из снимка в tenant.root. В формате store - из снимка snapshot_id
+    хранилища store_root, по умолчанию из последнего снимка тенанта snapshot_tenant (имя в хранилище,
+    по умолчанию tenant.store_name; чтобы перенести снимок другого тенанта, передайте его store_name).
+    report - RunReport, куда записать метрики прогона.
+    verify - после восстановления сверить тенант со снимком; отчёт о расхождениях пишется в verify_path.
+    selection - ObjectSelection: восстановить (и проверить) только выбранные объекты и их зависимости.
+    Возвращает VerifyReport или None, если проверки не было."""
     start_time = time.time()
-    headers = await get_headers(creds['RESTORE_HOST'], creds['RESTORE_USERNAME'], creds['RESTORE_PASSWORD'])
-    
-    await restore_user_actions(headers)
-    await restore_global_lists(headers)
-    await restore_templates(headers)
-    
-
-    await restore_templates_rules(headers)
-    await restore_policies(headers)
-    await restore_policies_rules(headers)
+    report = report if report is not None else RunReport('restore')
+    snapshot_tenant = snapshot_tenant or tenant.store_name
+    snapshot = open_snapshot(snapshot_format, root=tenant.root, store_root=store_root, tenant=snapshot_tenant,
+                             snapshot_id=snapshot_id)
+    if snapshot_format == 'store' and not snapshot.exists():
+        raise RuntimeError(f'В хранилище {store_root} нет снимков тенанта {snapshot_tenant}')
+    # Пробный прогон ничего не меняет в тенанте и не трогает журнал
+    journal = CheckpointJournal(os.path.join(tenant.root, RESTORE_JOURNAL), resume, read_only=dry_run)
+    records = select_records(snapshot, selection) if selection is not None else snapshot
+    plan = RestorePlan(dry_run)
+    verification = None
+    if journal.resumed:
+        print(f"Продолжаем прерванное восстановление: уже готово {journal.resumed} единиц")
+    # Один клиент (и один пул соединений) на всё восстановление
+    async with ApiClient(tenant.host, tenant.max_concurrency, budget=budget, page_size=tenant.page_size) as client:
+        report.add_client(tenant.name, client)
+        await get_headers(client, tenant.username, tenant.password)
+        try:
+            await run_restore_stages(client, records, journal, plan, report)
+            # Проверка идёт до закрытия снимка: файлы списков архива и хранилища доступны, пока он открыт
+            if verify and not dry_run:
+                verification = await verify_restore(client, records, report)
+            report_retries(client)
+        except BaseException:
+            # Журнал оставляем: с --resume восстановление продолжится с места падения
+            journal.close()
+            raise
+        finally:
+            snapshot.close()
+    plan.summary()
+    if dry_run:
+        journal.close()
+        print('Пробный прогон: тенант не изменён')
+        return
+    journal.finish()
+    save_verification(verification, verify_path)
 
     end_time = time.time()
     execution_time = end_time - start_time
     print(f"Восстановление завершено! Время выполнения: {execution_time:.2f} секунд")
+    return verification
+
+
+'''Синхронизация тенантов'''
+class RecordsSnapshot:
+    """Снимок из готовых записей в памяти: этапы восстановления получают объекты по одному.
+    Файлы списков берутся из снимка files."""
+    def __init__(self, records, files):
+        self.records = records
+        self.files = files
+
+    def read(self, kind):
+        return self.records.get(kind, [])
+
+    def list_file_path(self, name):
+        return self.files.list_file_path(name)
+
+class SyncRecordWriter:
+    """Записи одного вида: пишутся во вложенный снимок и сразу передаются синхронизации."""
+    def __init__(self, writer, kind, sync):
+        self.writer = writer
+        self.kind = kind
+        self.sync = sync
+
+    def append(self, item):
+        self.writer.append(item)
+        self.sync.on_record(self.kind, item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __enter__(self):
+        self.writer.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.writer.__exit__(exc_type, exc, tb)
+        if exc_type is None:
+            self.sync.on_complete(self.kind)
+
+class SyncSnapshot:
+    """Снимок-посредник для синхронизации: всё, что бекап записал, сразу уходит на восстановление.
+
+    Записи и файлы списков попадают во вложенный каталог-снимок: либо сохраняемый, либо временный.
+    """
+    format = 'dir'
+
+    def __init__(self, files, sync):
+        self.files = files
+        self.sync = sync
+        self.root = files.root
+
+    def records(self, kind):
+        return SyncRecordWriter(self.files.records(kind), kind, self.sync)
+
+    def list_file(self, name):
+        return self.files.list_file(name)
+
+    def list_file_path(self, name):
+        return self.files.list_file_path(name)
+
+    def has_list_file(self, name):
+        return self.files.has_list_file(name)
+
+    def close(self):
+        self.files.close()
+
+class TenantSync:
+    """Восстанавливает объекты в целевом тенанте по мере того, как бекап исходного их записывает.
+
+    Шаблон создаётся, как только прочитан, его правила патчатся, когда созданы шаблон, действия
+    и списки. Приложение ждёт свой шаблон, правила его политики - ещё и действия со списками.
+    Действия и списки восстанавливаются целиком, как только бекап записал их все.
+    """
+    def __init__(self, client, files, journal, plan, report):
+        self.client = client
+        self.files = files
+        self.journal = journal
+        self.plan = plan
+        self.report = report
+        loop = asyncio.get_running_loop()
+        self.restored = {'user_actions': loop.create_future(), 'global_lists': loop.create_future()}
+        self.templates = collections.defaultdict(loop.create_future)  # Имя шаблона -> шаблон есть в тенанте
+        self.buffered = collections.defaultdict(list)
+        self.template_tasks = []
+        self.tasks = []
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.append(task)
+        return task
+
+    def on_record(self, kind, record):
+        if kind == 'templates':
+            self.template_tasks.append(self.spawn(self.sync_template(record)))
+        elif kind == 'template_rules':
+            self.spawn(self.sync_template_rules(record))
+        elif kind == 'policy_rules':
+            self.spawn(self.sync_policy(record))
+        else:
+            self.buffered[kind].append(record)
+
+    def on_complete(self, kind):
+        if kind == 'user_actions':
+            self.spawn(self.sync_all(restore_user_actions, kind))
+        elif kind == 'global_lists':
+            self.spawn(self.sync_all(restore_global_lists, kind))
+        elif kind == 'templates':
+            self.spawn(self.templates_complete())
+
+    async def restore(self, stage, kind, records):
+        snapshot = RecordsSnapshot({kind: records}, self.files)
+        await self.report.timed(self.client, stage(self.client, snapshot, self.journal, self.plan))
+
+    async def sync_all(self, stage, kind):
+        try:
+            await self.restore(stage, kind, self.buffered.pop(kind, []))
+        finally:
+            resolve(self.restored[kind])
+
+    async def sync_template(self, record):
+        try:
+            await self.restore(restore_templates, 'templates', [record])
+        finally:
+            resolve(self.templates[record['name']])
+
+    async def templates_complete(self):
+        """Все шаблоны прочитаны: кто ждёт шаблон, которого в исходном тенанте нет, дальше не ждёт."""
+        await asyncio.gather(*self.template_tasks, return_exceptions=True)
+        for future in self.templates.values():
+            resolve(future)
+
+    async def sync_template_rules(self, entry):
+        await asyncio.gather(self.templates[entry['template_name']], *self.restored.values())
+        await self.restore(restore_templates_rules, 'template_rules', [entry])
+
+    async def sync_policy(self, entry):
+        await self.templates[entry['based_on_name']]
+        await self.restore(restore_policies, 'policy_rules', [entry])
+        await asyncio.gather(*self.restored.values())
+        await self.restore(restore_policies_rules, 'policy_rules', [entry])
+
+    async def wait(self):
+        # Задачи появляются, пока идёт бекап; после него список уже не растёт
+        await asyncio.gather(*self.tasks)
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+def resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+async def sync(source, target, root=None, dry_run=False, budget=None, report=None, verify=False, verify_path=None,
+               selection=None):
+    """Переносит конфигурацию из тенанта source в target напрямую, без бекапа целиком на диск.
+
+    Бекап и восстановление идут одновременно: объект уходит в target сразу, как только прочитан
+    из source и готово всё, от чего он зависит. root - каталог, куда заодно сохранить снимок;
+    без него файлы списков проходят через временный каталог, который потом удаляется.
+    Восстановление идемпотентно, поэтому прерванную синхронизацию достаточно запустить заново.
+    report - RunReport, куда записать метрики прогона.
+    verify, verify_path - как у restore: после переноса сверить целевой тенант с прочитанным снимком.
+    selection - ObjectSelection: переносить только выбранные объекты и их зависимости.
+    """
+    start_time = time.time()
+    report = report if report is not None else RunReport('sync')
+    verification = None
+    files_root = root if root is not None else tempfile.mkdtemp(prefix='ptaf-sync-')
+    files = DirectorySnapshot(files_root)
+    # Журнал только в памяти: повторный запуск сам пропустит уже перенесённое
+    journal = CheckpointJournal(None, read_only=True)
+    plan = RestorePlan(dry_run, quiet=True)
+    try:
+        async with ApiClient(source.host, source.max_concurrency, budget=budget,
+                             page_size=source.page_size) as source_client, \
+                ApiClient(target.host, target.max_concurrency, budget=budget,
+                          page_size=target.page_size) as target_client:
+            report.add_client(source.name, source_client)
+            report.add_client(target.name, target_client)
+            await asyncio.gather(get_headers(source_client, source.username, source.password),
+                                 get_headers(target_client, target.username, target.password))
+            stream = TenantSync(target_client, files, journal, plan, report)
+            snapshot = SyncSnapshot(files, stream)
+            try:
+                await run_backup_stages(source_client, snapshot, report, selection=selection)
+                await stream.wait()
+            except BaseException:
+                stream.cancel()
+                raise
+            if verify and not dry_run:
+                verification = await verify_restore(target_client, files, report)
+            report_retries(source_client)
+            report_retries(target_client)
+        snapshot.close()
+    finally:
+        if root is None:
+            shutil.rmtree(files_root, ignore_errors=True)
+    plan.summary()
+    save_verification(verification, verify_path)
+
+    end_time = time.time()
+    execution_time = end_time - start_time
+    if dry_run:
+        print('Пробный прогон: целевой тенант не изменён')
+    print(f"Синхронизация завершена! Время выполнения: {execution_time:.2f} секунд")
+    return verification
+
+
+'''Пакетный бекап'''
+# Сколько запросов одновременно на все тенанты процесса
+GLOBAL_CONCURRENCY = 100
+# Сколько тенантов бекапится одновременно
+MAX_PARALLEL_TENANTS = 8
+
+async def backup_many(tenants, global_concurrency=GLOBAL_CONCURRENCY, parallel_tenants=MAX_PARALLEL_TENANTS, **options):
+    """Бекапит несколько тенантов в одном цикле событий, каждый в свой каталог.
+
+    У каждого тенанта свой клиент и свой лимит запросов, сверху действует общий бюджет
+    global_concurrency. Ошибка одного тенанта не прерывает остальных.
+    Возвращает {имя тенанта: исключение или None}.
+    """
+    budget = asyncio.Semaphore(global_concurrency)
+    running = asyncio.Semaphore(parallel_tenants)
+
+    async def run(tenant):
+        async with running:
+            try:
+                await backup(tenant, budget=budget, **options)
+            except Exception as e:
+                print(f"Тенант {tenant.name}: бекап не выполнен: {e}")
+                return e
+
+    results = dict(zip((tenant.name for tenant in tenants), await asyncio.gather(*(run(tenant) for tenant in tenants))))
+    failed = [name for name, error in results.items() if error is not None]
+    print(f"Пакетный бекап: успешно {len(results) - len(failed)} из {len(results)}")
+    if failed:
+        print(f"С ошибками: {', '.join(failed)}")
+    return results
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Бекап/восстановление средней колонки в тенанте PT AF')
+    parser.add_argument('--concurrency', type=int, default=MAX_CONCURRENCY,
+                        help=f'максимум одновременных запросов к API тенанта (по умолчанию {MAX_CONCURRENCY})')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE,
+                        help=f'сколько элементов запрашивать в одной странице листинга (по умолчанию {PAGE_SIZE})')
+    parser.add_argument('--incremental', action='store_true',
+                        help='инкрементальный бекап: не перезапрашивать объекты, не изменившиеся с прошлого снимка')
+    parser.add_argument('--format', choices=['dir', 'archive', 'store'], default='dir',
+                        help='формат снимка: каталог с JSON (dir), один сжатый NDJSON-архив (archive) '
+                             'или очередной снимок в хранилище с дедупликацией (store)')
+    parser.add_argument('--store-dir', default=STORE_ROOT,
+                        help=f'каталог хранилища снимков для --format store (по умолчанию {STORE_ROOT})')
+    parser.add_argument('--snapshot',
+                        help='id снимка в хранилище для восстановления или выгрузки (по умолчанию последний)')
+    parser.add_argument('--list-snapshots', action='store_true',
+                        help='показать снимки в хранилище и выйти')
+    parser.add_argument('--keep-last', type=int,
+                        help='политика хранения: сколько последних снимков каждого тенанта оставлять')
+    parser.add_argument('--keep-daily', type=int,
+                        help='политика хранения: за сколько последних дней оставлять по одному снимку в день')
+    parser.add_argument('--prune', action='store_true',
+                        help='применить --keep-last/--keep-daily к хранилищу, удалить ненужные объекты и выйти')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default='gzip',
+                        help='сжатие архива; для zstd нужен пакет zstandard')
+    parser.add_argument('--resume', action='store_true',
+                        help='продолжить прерванный бекап/восстановление по журналу контрольных точек')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='только сверить бекап с целевым тенантом и напечатать план восстановления')
+    parser.add_argument('--export-dir', action='store_true',
+                        help='выгрузить архивный снимок из backup (или с --format store снимок из хранилища) '
+                             'в привычный каталог с JSON и выйти')
+    parser.add_argument('--verify', action='store_true',
+                        help='после восстановления (режимы 2-4) перечитать тенант и сверить его со снимком; '
+                             'при расхождениях код выхода 1')
+    parser.add_argument('--verify-report',
+                        help='записать расхождения проверки в JSON-файл (включает --verify)')
+    for kind, (option, label) in SELECTION_KINDS.items():
+        parser.add_argument(f'--include-{option}', action='append', dest=f'include_{kind}', metavar='ШАБЛОН',
+                            help=f'{label}: обрабатывать только эти (имя, glob или id; ключ можно повторять) '
+                                 f'и то, от чего они зависят')
+        parser.add_argument(f'--exclude-{option}', action='append', dest=f'exclude_{kind}', metavar='ШАБЛОН',
+                            help=f'{label}: не обрабатывать эти, даже как зависимость')
+    parser.add_argument('--keep-snapshot', action='store_true',
+                        help='при прямой синхронизации (режим 4) заодно сохранить снимок в backup')
+    parser.add_argument('--inventory',
+                        help='INI-файл со списком тенантов: бекап всех тенантов без вопросов и выход')
+    parser.add_argument('--output-dir', default='backups',
+                        help='каталог для снимков тенантов из --inventory, каждый в своём подкаталоге')
+    parser.add_argument('--global-concurrency', type=int, default=GLOBAL_CONCURRENCY,
+                        help=f'максимум одновременных запросов на все тенанты (по умолчанию {GLOBAL_CONCURRENCY})')
+    parser.add_argument('--parallel-tenants', type=int, default=MAX_PARALLEL_TENANTS,
+                        help=f'сколько тенантов бекапить одновременно (по умолчанию {MAX_PARALLEL_TENANTS})')
+    parser.add_argument('--metrics',
+                        help='записать в файл JSON-отчёт о прогоне: этапы, запросы, задержки и объём по эндпоинтам')
+    parser.add_argument('--prometheus',
+                        help='записать те же метрики в textfile для node_exporter (Prometheus)')
+    args = parser.parse_args()
+
+    def make_selection():
+        """Выборка из ключей --include-.../--exclude-...; None - обрабатывать весь тенант."""
+        selection = ObjectSelection({kind: getattr(args, f'include_{kind}') for kind in SELECTION_KINDS},
+                                    {kind: getattr(args, f'exclude_{kind}') for kind in SELECTION_KINDS})
+        return selection if selection.include or selection.exclude else None
+
+    def save_report(report):
+        if args.metrics:
+            report.write_json(args.metrics)
+            print(f'Отчёт о прогоне: {args.metrics}')
+        if args.prometheus:
+            report.write_prometheus(args.prometheus)
+        if args.metrics or args.prometheus:
+            report.print_summary()
+
+    if args.list_snapshots:
+        print_snapshots(args.store_dir)
+        raise SystemExit
+
+    if args.prune:
+        prune_store(args.store_dir, args.keep_last, args.keep_daily)
+        raise SystemExit
+
+    if args.export_dir:
+        if args.format == 'store':
+            source_snapshot = open_snapshot('store', store_root=args.store_dir, snapshot_id=args.snapshot)
+            export_snapshot(source_snapshot, open_snapshot('dir'))
+            print('Снимок из хранилища выгружен в директорию backup')
+        else:
+            export_snapshot(open_snapshot('archive'), open_snapshot('dir'))
+            print('Архив выгружен в директорию backup')
+        raise SystemExit
+
+    if args.inventory:
+        tenants = load_inventory(args.inventory, args.output_dir, args.concurrency, args.page_size)
+        report = RunReport('backup')
+        results = asyncio.run(backup_many(tenants, args.global_concurrency, args.parallel_tenants,
+                                          incremental=args.incremental, snapshot_format=args.format,
+                                          compression=args.compression, resume=args.resume, report=report,
+                                          store_root=args.store_dir, selection=make_selection()))
+        save_report(report)
+        if args.format == 'store' and (args.keep_last or args.keep_daily):
+            prune_store(args.store_dir, args.keep_last, args.keep_daily)
+        raise SystemExit(1 if any(results.values()) else 0)
+
     print('ПРОВЕРЬТЕ КОРРЕКТНОСТЬ ЗАПОЛНЕНИЯ CREDS.TXT!!! ЕСЛИ ПРЕПУТАТЬ, ВСЁ МОЖЕТ СЛОМАТЬСЯ В СОХРАНЯЕМОМ ТЕНАНТЕ!!!')
     try:
-        mode = input('Вы хотите сделать бекап(1), восстановиться из бекапа(2), или и то и другое(3)? Введите число: ')
-        match int(mode):
-            case 1:
-                asyncio.run(backup())
-            case 2:
-                asyncio.run(restore())
-            case 3:
-                asyncio.run(backup())
-                asyncio.run(restore())
-            case _:
-                print("Как можно было лажануть в выборе из трёх цифр?")
+        creds = load_credentials('creds.txt')
+        source = Tenant.from_creds(creds, 'BACKUP', max_concurrency=args.concurrency, page_size=args.page_size)
+        target = Tenant.from_creds(creds, 'RESTORE', max_concurrency=args.concurrency, page_size=args.page_size)
+        mode = input('Вы хотите сделать бекап(1), восстановиться из бекапа(2), или и то и другое(3), '
+                     'или перенести напрямую из тенанта в тенант(4)? Введите число: ')
+
+        verify = args.verify or args.verify_report is not None
+        report = verification = None
+        # Отчёт пишется и после ошибки: по нему видно, на чём застрял прогон
+        try:
+            match int(mode):
+                case 1:
+                    report = RunReport('backup')
+                    asyncio.run(backup(source, args.incremental, args.format, args.compression, args.resume,
+                                       report=report, store_root=args.store_dir, selection=make_selection()))
+                case 2:
+                    report = RunReport('restore')
+                    verification = asyncio.run(restore(target, args.format, args.resume, args.dry_run, report=report,
+                                                       store_root=args.store_dir, snapshot_id=args.snapshot,
+                                                       snapshot_tenant=source.store_name,
+                                                       verify=verify, verify_path=args.verify_report,
+                                                       selection=make_selection()))
+                case 3:
+                    report = RunReport('backup_restore')
+                    asyncio.run(backup(source, args.incremental, args.format, args.compression, args.resume,
+                                       report=report, store_root=args.store_dir, selection=make_selection()))
+                    verification = asyncio.run(restore(target, args.format, args.resume, args.dry_run, report=report,
+                                                       store_root=args.store_dir, snapshot_id=args.snapshot,
+                                                       snapshot_tenant=source.store_name,
+                                                       verify=verify, verify_path=args.verify_report,
+                                                       selection=make_selection()))
+                case 4:
+                    report = RunReport('sync')
+                    verification = asyncio.run(sync(source, target, source.root if args.keep_snapshot else None,
+                                                    args.dry_run, report=report, verify=verify,
+                                                    verify_path=args.verify_report, selection=make_selection()))
+                case _:
+                    print("Как можно было лажануть в выборе из четырёх цифр?")
+        finally:
+            if report is not None:
+                save_report(report)
+        if verification is not None and verification.mismatches:
+            raise SystemExit(1)
     except Exception as e:
         print(f'Fatal error:\n{e}')
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""Бенчмарк перевода переменных правил: VariableTranslator против прежней рекурсивной замены.
+
+Генерирует переменные правил двух видов: обычные (несколько переменных, пара ссылок на списки)
+и большие (глубокое дерево с длинными списками, где ссылок мало). Для каждого вида меряет
+время id -> имя (бекап) и имя -> id (восстановление) и объём памяти, который занимают результаты,
+и проверяет, что результаты совпадают с прежней версией. Отдельно сверяет с прежней версией
+правила с одним именем, но разной формой переменных: ссылки в местах, которых не было у первого
+правила, тоже должны переводиться.
+
+Пример:
+    python bench/bench_variables.py --rules 2000 --repeat 5
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import async_backup  # noqa: E402
+
+
+def legacy_replace_value_with_name(data, id_to_name):
+    """Прежняя версия из async_backup.py: копирует каждый словарь и список на каждом уровне."""
+    data = data.copy() if isinstance(data, dict) else data[:] if isinstance(data, list) else data
+
+    if isinstance(data, dict):
+        if 'global_param_type' in data:
+            value = data.get('value')
+            if isinstance(value, list):
+                data['value'] = [id_to_name.get(item, item) for item in value]
+            elif isinstance(value, str):
+                data['value'] = id_to_name.get(value, value)
+            return data
+        for key, value in data.items():
+            data[key] = legacy_replace_value_with_name(value, id_to_name)
+        return data
+    elif isinstance(data, list):
+        for i, item in enumerate(data):
+            data[i] = legacy_replace_value_with_name(item, id_to_name)
+        return data
+    else:
+        return data
+
+
+def make_rule(index, list_ids, large, rnd):
+    """Переменные одного правила; схема зависит от номера правила, значения - случайные."""
+    variables = {
+        'enabled_check': {'value': rnd.random() < 0.5},
+        'threshold': {'value': rnd.randint(1, 100)},
+        'sources': {'global_param_type': 'list', 'value': rnd.sample(list_ids, 2)},
+        'exceptions': [{'global_param_type': 'list', 'value': rnd.choice(list_ids)}],
+    }
+    if large:
+        variables['patterns'] = {'value': [{'pattern': f'p{index}-{i}', 'weight': i, 'flags': ['i', 'm']}
+                                           for i in range(100)]}
+        variables['zones'] = [{'name': f'z{i}', 'limits': {'rate': {'value': i}, 'burst': {'value': i * 2}},
+                               'allow': {'global_param_type': 'list', 'value': [rnd.choice(list_ids)]}}
+                              for i in range(20)]
+    return {'name': f'Rule {index % 50}', 'variables': variables}
+
+
+def make_mixed_rules(list_ids, rnd):
+    """Правила с одним именем и одними переменными верхнего уровня, но разной формой внутри:
+    ссылка на месте скаляра, словаря без ссылок или в новом ключе, списки с разными элементами."""
+    def reference():
+        return {'global_param_type': 'list', 'value': rnd.choice(list_ids)}
+    variants = [
+        lambda: {'x': 1},
+        lambda: reference(),
+        lambda: {'x': 1, 'extra': reference()},
+        lambda: {'value': 'plain'},
+        lambda: {'value': reference()},
+        lambda: {'value': [reference(), 'plain']},
+        lambda: [],
+        lambda: [{'x': 1}, reference()],
+        lambda: [[reference()]],
+        lambda: 'plain',
+    ]
+    rules = []
+    for index in range(200):
+        variables = {
+            'lists': reference(),
+            'hosts': {'entries': [rnd.choice(variants)() for _ in range(rnd.randint(0, 3))]},
+            'options': rnd.choice(variants)(),
+        }
+        rules.append({'name': f'Mixed {index % 3}', 'variables': variables})
+    return rules
+
+
+def check_mixed(translator, id_to_name):
+    """Сверяет перевод правил со смешанной формой с прежней версией в обе стороны."""
+    rnd = random.Random(2)
+    name_to_id = {name: id for id, name in id_to_name.items()}
+    rules = make_mixed_rules(sorted(id_to_name), rnd)
+    for direction, mapping in (('id -> имя', id_to_name), ('имя -> id', name_to_id)):
+        if mapping is name_to_id:
+            rules = [{**rule, 'variables': legacy_replace_value_with_name(rule['variables'], id_to_name)}
+                     for rule in rules]
+        for rule in rules:
+            expected = legacy_replace_value_with_name(rule['variables'], mapping)
+            variables, unresolved = translator.translate(rule['name'], rule['variables'], mapping)
+            if variables != expected or unresolved:
+                raise SystemExit(f'смешанные правила, {direction}: {rule["variables"]} переведены в {variables}, '
+                                 f'не найдены {unresolved}, ожидалось {expected}')
+
+
+def measure(func, rules, repeat):
+    """Лучшее время из repeat прогонов и память, которую занимают результаты одного прогона."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for rule in rules:
+            func(rule)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    results = [func(rule) for rule in rules]
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return best, retained, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк перевода переменных правил')
+    parser.add_argument('--rules', type=int, default=2000, help='правил в каждом наборе')
+    parser.add_argument('--lists', type=int, default=50, help='глобальных списков')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов, берётся лучшее время')
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    id_to_name = {f'gl{i}': f'list {i}' for i in range(args.lists)}
+    name_to_id = {name: id for id, name in id_to_name.items()}
+    translator = async_backup.VariableTranslator()
+    check_mixed(translator, id_to_name)
+
+    print(f"{'набор':<10}{'направление':<14}{'было, мс':>10}{'стало, мс':>11}{'было, КБ':>10}{'стало, КБ':>11}")
+    for kind, large in (('обычные', False), ('большие', True)):
+        rules = [make_rule(i, sorted(id_to_name), large, rnd) for i in range(args.rules)]
+        for direction, mapping in (('id -> имя', id_to_name), ('имя -> id', name_to_id)):
+            if mapping is name_to_id:
+                # Восстанавливаем то, что получилось бы в бекапе
+                rules = [{**rule, 'variables': legacy_replace_value_with_name(rule['variables'], id_to_name)}
+                         for rule in rules]
+            old_time, old_memory, old = measure(
+                lambda rule: legacy_replace_value_with_name(rule['variables'], mapping), rules, args.repeat)
+            new_time, new_memory, new = measure(
+                lambda rule: translator.translate(rule['name'], rule['variables'], mapping)[0], rules, args.repeat)
+            if old != new:
+                raise SystemExit(f'{kind}, {direction}: результаты не совпадают с прежней версией')
+            print(f"{kind:<10}{direction:<14}{old_time * 1000:>10.1f}{new_time * 1000:>11.1f}"
+                  f"{old_memory / 1024:>10.0f}{new_memory / 1024:>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""Локальный мок API PT AF для бенчмарков async_backup.py.
+
+Поднимает два тенанта на соседних портах: исходный (синтетическая конфигурация заданного
+размера) и пустой целевой для восстановления. Умеет добавлять задержку и случайные 503.
+Статистика запросов отдаётся без авторизации по /_bench/stats на обоих портах.
+
+Запуск: python bench/mock_server.py --port 8443 --cert cert.pem --key key.pem
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import ssl
+import time
+import uuid
+
+from aiohttp import web
+
+API = '/api/ptaf/v4'
+
+
+def make_tenant(templates=3, policies=5, rules=200, overrides=10, lists=4, list_lines=1000, seed=1):
+    """Синтетическая конфигурация тенанта.
+
+    overrides - сколько правил изменено в каждом шаблоне и каждой политике.
+    Чётные списки статические (с файлом), нечётные - динамические.
+    """
+    rnd = random.Random(seed)
+    tenant = {
+        'action_types': [{'id': f'at{i}', 'name': name} for i, name in enumerate(['block', 'log', 'syslog'])],
+        'actions': [
+            {'id': 'sa0', 'name': 'Block', 'is_system': True, 'type_id': 'at0', 'params': {}},
+            {'id': 'ua0', 'name': 'MySyslog', 'is_system': False, 'type_id': 'at2', 'params': {'host': 'syslog.local'}},
+        ],
+        'lists': {},
+        'rules': {f'r{i}': f'Rule {i}' for i in range(rules)},
+        'vendor': {'v0': {'id': 'v0', 'name': 'Default'}, 'v1': {'id': 'v1', 'name': 'Strict'}},
+        'user': {},
+        'policies': {},
+        'overrides': {},
+    }
+    for i in range(lists):
+        static = i % 2 == 0
+        tenant['lists'][f'gl{i}'] = {
+            'id': f'gl{i}', 'name': f'list{i}', 'type': 'STATIC' if static else 'DYNAMIC',
+            # Пробелы и пустые строки - как в реальных выгрузках, скрипт их нормализует
+            'file': '\n'.join(f' 10.{i // 256}.{i % 256}.{j % 256} \n' for j in range(list_lines)) if static else '',
+        }
+    rule_ids = sorted(tenant['rules'])
+    list_ids = sorted(tenant['lists'])
+    for i in range(templates):
+        template_id = f'ut{i}'
+        tenant['user'][template_id] = {'id': template_id, 'name': f'Template {i}',
+                                       'templates': [f'v{i % 2}'], 'has_user_rules': False}
+        for rule_id in rnd.sample(rule_ids, min(overrides, rules)):
+            tenant['overrides'][(template_id, rule_id)] = {
+                'enabled': False, 'actions': ['sa0', 'ua0'],
+                'variables': {'lists': {'global_param_type': 'list', 'value': list_ids[:2]}, 'count': {'value': 3}},
+            }
+    for i in range(policies):
+        policy_id = f'p{i}'
+        tenant['policies'][policy_id] = {'id': policy_id, 'name': f'Application {i}',
+                                         'template_id': f'ut{i % templates}' if templates else None}
+        for rule_id in rnd.sample(rule_ids, min(overrides, rules)):
+            tenant['overrides'][(policy_id, rule_id)] = {
+                'enabled': True, 'actions': ['ua0'],
+                'variables': {'lists': [{'global_param_type': 'list', 'value': list_ids[-1] if list_ids else ''}]},
+            }
+    return tenant
+
+
+def empty_tenant(rules=200):
+    """Целевой тенант: только системные справочники, правила и системное действие."""
+    tenant = make_tenant(templates=0, policies=0, rules=rules, lists=0)
+    tenant['actions'] = tenant['actions'][:1]
+    return tenant
+
+
+def rule_details(tenant, owner, rule_id, full=True):
+    override = tenant['overrides'].get((owner, rule_id))
+    details = {'id': rule_id, 'name': tenant['rules'][rule_id], 'is_system': True, 'has_overrides': override is not None}
+    if full:
+        details.update({'enabled': True, 'actions': ['sa0'],
+                        'variables': {'lists': {'global_param_type': 'list', 'value': []}, 'count': {'value': 1}}})
+        if override:
+            details.update(json.loads(json.dumps(override)))
+    return details
+
+
+def make_token(ttl):
+    token = 'tok' + uuid.uuid4().hex
+    if ttl:
+        # Похоже на JWT: клиент читает срок жизни из поля exp
+        payload = base64.urlsafe_b64encode(json.dumps({'exp': time.time() + ttl}).encode()).decode().rstrip('=')
+        token += f'.{payload}.sig'
+    return token
+
+
+def token_expired(token):
+    parts = token.split('.')
+    if len(parts) != 3:
+        return False
+    return json.loads(base64.urlsafe_b64decode(parts[1] + '=' * (-len(parts[1]) % 4)))['exp'] < time.time()
+
+
+def make_app(tenant, latency=0.0, error_rate=0.0, token_ttl=0, seed=None, rules_filter=True):
+    """aiohttp-приложение с эндпоинтами, которыми пользуется скрипт.
+
+    Листинги понимают limit/offset; листинг правил - фильтр has_overrides=true, а с rules_filter=False
+    отвечает на него 400, как сервер, который фильтра не знает.
+    """
+    stats = {'requests': 0, 'errors_injected': 0, 'logins': 0, 'bytes_out': 0}
+    rnd = random.Random(seed)
+
+    @web.middleware
+    async def middleware(request, handler):
+        if request.path == '/_bench/stats':
+            return await handler(request)
+        stats['requests'] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        if error_rate and rnd.random() < error_rate:
+            stats['errors_injected'] += 1
+            return web.Response(status=503, text='<html>Service Unavailable</html>', content_type='text/html')
+        if not request.path.endswith('/auth/refresh_tokens'):
+            auth = request.headers.get('Authorization', '')
+            if not auth.startswith('Bearer tok') or token_expired(auth[len('Bearer '):]):
+                return web.json_response({'error': 'unauthorized'}, status=401)
+        response = await handler(request)
+        if response.body is not None and hasattr(response.body, '__len__'):
+            stats['bytes_out'] += len(response.body)
+        return response
+
+    def items(request, values):
+        offset = int(request.query.get('offset', 0))
+        limit = int(request.query.get('limit', len(values)))
+        return web.json_response({'items': values[offset:offset + limit], 'total': len(values)})
+
+    def owner_of(request):
+        return request.match_info.get('id') or request.match_info.get('pid')
+
+    def unique_name(collection, name):
+        return not any(value['name'] == name for value in collection)
+
+    async def login(request):
+        stats['logins'] += 1
+        return web.json_response({'access_token': make_token(token_ttl), 'refresh_token': 'refresh'})
+
+    async def templates_list(request):
+        return items(request, [{'id': v['id'], 'name': v['name']} for v in tenant[request.match_info['owner']].values()])
+
+    async def template_get(request):
+        return web.json_response(tenant[request.match_info['owner']][request.match_info['id']])
+
+    async def template_create(request):
+        body = await request.json()
+        if not unique_name(tenant['user'].values(), body['name']):
+            return web.json_response({'error': 'not unique'}, status=422)
+        template_id = 'ut' + uuid.uuid4().hex[:8]
+        tenant['user'][template_id] = {'id': template_id, **body}
+        return web.json_response(tenant['user'][template_id], status=201)
+
+    async def rules_list(request):
+        owner = owner_of(request)
+        rules = [rule_details(tenant, owner, rule_id, full=False) for rule_id in tenant['rules']]
+        if 'has_overrides' in request.query:
+            if not rules_filter:
+                return web.json_response({'error': 'unknown parameter has_overrides'}, status=400)
+            rules = [rule for rule in rules if rule['has_overrides'] == (request.query['has_overrides'] == 'true')]
+        return items(request, rules)
+
+    async def rule_get(request):
+        return web.json_response(rule_details(tenant, owner_of(request), request.match_info['rid']))
+
+    async def rule_patch(request):
+        body = await request.json()
+        owner, rule_id = owner_of(request), request.match_info['rid']
+        if rule_id not in tenant['rules']:
+            return web.json_response({'error': 'not found'}, status=404)
+        tenant['overrides'][(owner, rule_id)] = body
+        return web.json_response(rule_details(tenant, owner, rule_id))
+
+    async def policies_list(request):
+        return items(request, [{'id': v['id'], 'name': v['name']} for v in tenant['policies'].values()])
+
+    async def policy_get(request):
+        return web.json_response(tenant['policies'][request.match_info['pid']])
+
+    async def application_create(request):
+        body = await request.json()
+        if not unique_name(tenant['policies'].values(), body['name']):
+            return web.json_response({'error': 'not unique'}, status=422)
+        policy_id = 'p' + uuid.uuid4().hex[:8]
+        tenant['policies'][policy_id] = {'id': policy_id, 'name': body['name'], 'template_id': body['policy_template_id']}
+        return web.json_response({'id': policy_id}, status=201)
+
+    async def lists_list(request):
+        return items(request, [{k: v for k, v in value.items() if k != 'file'} for value in tenant['lists'].values()])
+
+    async def list_file(request):
+        body = tenant['lists'][request.match_info['id']]['file']
+        etag = '"%08x"' % (hash(body) & 0xffffffff)
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        return web.Response(text=body, headers={'ETag': etag})
+
+    async def list_create(request):
+        form = await request.post()
+        if not unique_name(tenant['lists'].values(), form['name']):
+            return web.json_response({'error': 'not unique'}, status=422)
+        file = form.get('file')
+        list_id = 'gl' + uuid.uuid4().hex[:8]
+        tenant['lists'][list_id] = {'id': list_id, 'name': form['name'], 'type': form['type'],
+                                    'file': file.file.read().decode() if file is not None else ''}
+        return web.json_response({'id': list_id}, status=201)
+
+    async def lists_apply(request):
+        return web.json_response({})
+
+    async def actions_list(request):
+        return items(request, tenant['actions'])
+
+    async def action_create(request):
+        body = await request.json()
+        if not unique_name(tenant['actions'], body['name']):
+            return web.json_response({'error': 'not unique'}, status=422)
+        tenant['actions'].append({'id': 'a' + uuid.uuid4().hex[:8], 'is_system': False, **body})
+        return web.json_response(tenant['actions'][-1], status=201)
+
+    async def action_types_list(request):
+        return items(request, tenant['action_types'])
+
+    async def stats_get(request):
+        return web.json_response({**stats, 'objects': {
+            'templates': len(tenant['user']), 'policies': len(tenant['policies']),
+            'lists': len(tenant['lists']), 'actions': len(tenant['actions']), 'overrides': len(tenant['overrides'])}})
+
+    app = web.Application(middlewares=[middleware], client_max_size=1024 ** 3)
+    app.add_routes([
+        web.get('/_bench/stats', stats_get),
+        web.post(API + '/auth/refresh_tokens', login),
+        web.get(API + '/config/policies/templates/{owner}', templates_list),
+        web.post(API + '/config/policies/templates/user', template_create),
+        web.get(API + '/config/policies/templates/{owner}/{id}', template_get),
+        web.get(API + '/config/policies/templates/{owner}/{id}/rules', rules_list),
+        web.get(API + '/config/policies/templates/{owner}/{id}/rules/{rid}', rule_get),
+        web.patch(API + '/config/policies/templates/{owner}/{id}/rules/{rid}', rule_patch),
+        web.get(API + '/config/policies', policies_list),
+        web.get(API + '/config/policies/{pid}', policy_get),
+        web.get(API + '/config/policies/{pid}/rules', rules_list),
+        web.get(API + '/config/policies/{pid}/rules/{rid}', rule_get),
+        web.patch(API + '/config/policies/{pid}/rules/{rid}', rule_patch),
+        web.post(API + '/config/applications', application_create),
+        web.get(API + '/config/global_lists', lists_list),
+        web.post(API + '/config/global_lists', list_create),
+        web.post(API + '/config/global_lists/apply', lists_apply),
+        web.get(API + '/config/global_lists/{id}/file', list_file),
+        web.get(API + '/config/actions', actions_list),
+        web.post(API + '/config/actions', action_create),
+        web.get(API + '/config/action_types', action_types_list),
+    ])
+    return app
+
+
+async def serve(args):
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(args.cert, args.key)
+    source = make_tenant(args.templates, args.policies, args.rules, args.overrides, args.lists, args.list_lines)
+    target = empty_tenant(args.rules)
+    for port, tenant in ((args.port, source), (args.port + 1, target)):
+        runner = web.AppRunner(make_app(tenant, args.latency, args.error_rate, args.token_ttl, seed=port,
+                                        rules_filter=not args.no_rules_filter),
+                               access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port, ssl_context=ssl_context).start()
+    print('ready', flush=True)
+    await asyncio.Event().wait()
+
+
+def add_tenant_arguments(parser):
+    parser.add_argument('--templates', type=int, default=3, help='пользовательских шаблонов')
+    parser.add_argument('--policies', type=int, default=5, help='политик (приложений)')
+    parser.add_argument('--rules', type=int, default=200, help='системных правил в каждом шаблоне и политике')
+    parser.add_argument('--overrides', type=int, default=10, help='изменённых правил в каждом шаблоне и политике')
+    parser.add_argument('--lists', type=int, default=4, help='глобальных списков (половина - статические)')
+    parser.add_argument('--list-lines', type=int, default=1000, help='строк в файле статического списка')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка каждого ответа, секунд')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 503')
+    parser.add_argument('--token-ttl', type=float, default=0, help='срок жизни токена, секунд (0 - бессрочный)')
+    parser.add_argument('--no-rules-filter', action='store_true',
+                        help='листинг правил отвечает 400 на фильтр has_overrides')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Мок API PT AF: исходный тенант на --port, пустой целевой на --port + 1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--cert', required=True, help='сертификат TLS (PEM)')
+    parser.add_argument('--key', required=True, help='ключ TLS (PEM)')
+    add_tenant_arguments(parser)
+    asyncio.run(serve(parser.parse_args()))
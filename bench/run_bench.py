@@ -0,0 +1,208 @@
+"""Бенчмарк бекапа и восстановления на локальном моке API PT AF.
+
+Поднимает bench/mock_server.py с синтетическим тенантом заданного размера, затем в отдельных
+процессах запускает backup(), restore() (и при желании sync()) из async_backup.py и печатает
+время, число запросов, запросов в секунду и пиковую память (RSS) процесса скрипта.
+Каждый повтор идёт на свежем моке, чтобы восстановление всегда начиналось с пустого тенанта.
+
+Примеры:
+    python bench/run_bench.py --templates 20 --policies 50 --rules 500 --latency 0.02
+    python bench/run_bench.py --json results.json
+    python bench/run_bench.py --baseline results.json --tolerance 0.15
+
+Нужен openssl в PATH: мок работает по HTTPS с самоподписанным сертификатом.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from mock_server import add_tenant_arguments  # noqa: E402
+
+OPERATIONS = ('backup', 'restore', 'sync')
+
+
+def free_port_pair():
+    """Порт p, у которого свободен и p + 1: мок поднимает на них исходный и целевой тенанты."""
+    while True:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        with socket.socket() as sock:
+            try:
+                sock.bind(('127.0.0.1', port + 1))
+            except OSError:
+                continue
+        return port
+
+
+def make_certificate(directory):
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+@contextlib.contextmanager
+def mock_server(args, workdir):
+    cert, key = make_certificate(workdir)
+    port = free_port_pair()
+    command = [sys.executable, os.path.join(BENCH_DIR, 'mock_server.py'), '--port', str(port), '--cert', cert, '--key', key,
+               '--templates', str(args.templates), '--policies', str(args.policies), '--rules', str(args.rules),
+               '--overrides', str(args.overrides), '--lists', str(args.lists), '--list-lines', str(args.list_lines),
+               '--latency', str(args.latency), '--error-rate', str(args.error_rate), '--token-ttl', str(args.token_ttl)]
+    if args.no_rules_filter:
+        command.append('--no-rules-filter')
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    try:
+        if process.stdout.readline().strip() != 'ready':
+            raise RuntimeError('мок не запустился')
+        yield port
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def mock_stats(port):
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    with urllib.request.urlopen(f'https://127.0.0.1:{port}/_bench/stats', context=context) as response:
+        return json.load(response)
+
+
+def run_operation(operation, port, root, args):
+    """Запускает операцию в отдельном процессе, чтобы пиковая память была только её."""
+    command = [sys.executable, os.path.abspath(__file__), '--worker', operation, '--port', str(port),
+               '--root', root, '--concurrency', str(args.concurrency), '--page-size', str(args.page_size),
+               '--format', args.format]
+    if args.verify:
+        command.append('--verify')
+    ports = {'backup': [port], 'restore': [port + 1], 'sync': [port, port + 1]}[operation]
+    before = [mock_stats(p) for p in ports]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    after = [mock_stats(p) for p in ports]
+    result = json.loads(output.strip().splitlines()[-1])
+    result['requests'] = sum(a['requests'] - b['requests'] for a, b in zip(after, before))
+    result['errors_injected'] = sum(a['errors_injected'] - b['errors_injected'] for a, b in zip(after, before))
+    result['rps'] = result['requests'] / result['seconds'] if result['seconds'] else 0.0
+    return result
+
+
+def worker(args):
+    """Одна операция в этом процессе; в stdout - одна строка JSON с результатом."""
+    import async_backup
+
+    source = async_backup.Tenant('source', f'127.0.0.1:{args.port}', 'bench', 'bench', args.root, args.concurrency,
+                                 args.page_size)
+    target = async_backup.Tenant('target', f'127.0.0.1:{args.port + 1}', 'bench', 'bench', args.root, args.concurrency,
+                                 args.page_size)
+    operations = {
+        'backup': lambda: async_backup.backup(source, snapshot_format=args.format),
+        'restore': lambda: async_backup.restore(target, snapshot_format=args.format, verify=args.verify),
+        'sync': lambda: async_backup.sync(source, target, verify=args.verify),
+    }
+    log = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        asyncio.run(operations[args.worker]())
+    seconds = time.perf_counter() - started
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / 1024 ** 2 if sys.platform == 'darwin' else peak_rss / 1024
+    print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak_rss_mb}))
+
+
+def summarize(runs):
+    summary = {}
+    for operation in runs[0]:
+        results = [run[operation] for run in runs]
+        summary[operation] = {key: statistics.median(result[key] for result in results)
+                              for key in ('seconds', 'requests', 'rps', 'peak_rss_mb', 'errors_injected')}
+    return summary
+
+
+def print_table(summary):
+    print(f"{'операция':<10}{'время, с':>10}{'запросов':>10}{'запр/с':>10}{'RSS, МБ':>10}{'503':>8}")
+    for operation, result in summary.items():
+        print(f"{operation:<10}{result['seconds']:>10.2f}{result['requests']:>10.0f}{result['rps']:>10.0f}"
+              f"{result['peak_rss_mb']:>10.1f}{result['errors_injected']:>8.0f}")
+
+
+def check_regressions(summary, baseline, tolerance):
+    """Операции, которые стали медленнее или тяжелее базового прогона больше чем на tolerance."""
+    regressions = []
+    for operation, result in summary.items():
+        base = baseline.get('summary', {}).get(operation)
+        if base is None:
+            continue
+        for key in ('seconds', 'peak_rss_mb'):
+            if base[key] and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{operation}: {key} {base[key]:.2f} -> {result[key]:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк async_backup.py на локальном моке API PT AF')
+    add_tenant_arguments(parser)
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=['backup', 'restore'],
+                        help='что измерять (по умолчанию backup restore)')
+    parser.add_argument('--concurrency', type=int, default=20, help='--concurrency скрипта')
+    parser.add_argument('--page-size', type=int, default=500, help='--page-size скрипта')
+    parser.add_argument('--format', choices=['dir', 'archive'], default='dir', help='формат снимка')
+    parser.add_argument('--verify', action='store_true', help='проверять тенант после восстановления и синхронизации')
+    parser.add_argument('--repeat', type=int, default=1, help='число повторов, в отчёт идёт медиана')
+    parser.add_argument('--json', help='сохранить результаты в файл (годится как --baseline)')
+    parser.add_argument('--baseline', help='результаты прошлого прогона для поиска регрессий')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='допустимое ухудшение относительно --baseline')
+    # Служебные параметры процесса-исполнителя
+    parser.add_argument('--worker', choices=OPERATIONS, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--root', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    runs = []
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory(prefix='ptaf-bench-') as workdir, mock_server(args, workdir) as port:
+            root = os.path.join(workdir, 'backup')
+            if 'restore' in args.operations and 'backup' not in args.operations:
+                # Восстановлению нужен снимок: снимаем его, но не измеряем
+                run_operation('backup', port, root, args)
+            runs.append({operation: run_operation(operation, port, root, args) for operation in args.operations})
+
+    summary = summarize(runs)
+    print_table(summary)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump({'params': {k: v for k, v in vars(args).items() if k not in ('worker', 'port', 'root')},
+                       'summary': summary, 'runs': runs}, file, indent=4, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            regressions = check_regressions(summary, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Регрессия: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()